@@ -0,0 +1,426 @@
+"""bench.py
+
+Parity checks and timings for the panel processing, run from the REPL.
+Not part of the firmware, make bench builds build/bench.mpy to copy to
+the device by hand:
+
+    import bench
+    bench.check_move_mean()
+    bench.check_online_filter()
+    bench.check_backends()
+    bench.check_spill_limit()
+    bench.bench_move_mean()
+    bench.bench_backends()
+    bench.bench_judgment()
+    bench.bench_parse()
+    bench.bench_acquisition(laser)
+    bench.bench_write_panel(laser)
+
+On the host, python3 -m sim.benchmarks runs them against the simulator
+and checks the results for regressions.
+"""
+import gc
+import uos
+import utime
+
+from array import array
+
+import laser_ctrl
+import panel_format
+from laser_ctrl import (LaserCtrl, Panel, DATA_DIV, DATA_DIV_UM, MAX_PANEL_DATA,
+                        MAX_SPILL_DATA,
+                        FILTER_SIZE, UM_PER_MM, SD_FILE, FMT_TEXT, FMT_BIN,
+                        BACKEND_PYTHON, BACKEND_ULAB, frame_size)
+
+try:
+    import urandom as random
+except ImportError:
+    import random
+
+
+PANEL_LENGTHS = (20, 100, 300, MAX_PANEL_DATA)
+
+
+def _sample(th_um):
+    r = random.getrandbits(8)
+    if r < 10:
+        return th_um + DATA_DIV_UM * (2 + r)
+    return th_um + r - 128
+
+
+def fill_panel(panel, n, seed=1):
+    """Fill a panel with n noisy samples around its thickness
+
+    About one sample in 25 is an outlier outside thickness +- DATA_DIV.
+    """
+    random.seed(seed)
+    panel._in = n
+    for i in range(0, n):
+        panel._time[i] = i * 10000
+        for s in range(0, panel.stacks):
+            panel._data[s * MAX_PANEL_DATA + i] = _sample(panel.th_um)
+    return panel
+
+
+def feed_panel(panel, n, seed=1):
+    """Same samples as fill_panel, pushed through Panel.add_points"""
+    random.seed(seed)
+    ps = [0] * panel.stacks
+    for i in range(0, n):
+        for s in range(0, panel.stacks):
+            ps[s] = _sample(panel.th_um)
+        if i == 0:
+            panel.start_measure(ps)
+        else:
+            panel.add_points(ps)
+    return panel
+
+
+class _RefPanel:
+    """Float mm copy of a panel, as Panel stored it before the um path"""
+
+    def __init__(self, panel):
+        self.thickness = panel.thickness
+        self._in = panel._in
+        # One array per stack
+        self._data = [array('f', [d / UM_PER_MM for d in
+                                  panel._data[s * MAX_PANEL_DATA:s * MAX_PANEL_DATA + panel._in]])
+                      for s in range(0, panel.stacks)]
+        self._sdata = [array('f', [0.0] * panel._in) for s in range(0, panel.stacks)]
+        self.s_in = 0
+        return
+
+
+def ref_move_mean(panel):
+    """The original O(n * n/20) float moving mean, kept as the reference"""
+    filter_size = panel._in // 20
+    panel.s_in = panel._in - filter_size
+    stacks = len(panel._data)
+    for i in range(0, panel.s_in):
+        sums = [0] * stacks
+        n = filter_size
+        for j in range(0, filter_size):
+            out = False
+            for data in panel._data:
+                if (data[i + j] > panel.thickness + DATA_DIV
+                    or data[i + j] < panel.thickness - DATA_DIV):
+                    out = True
+            if out:
+                n -= 1
+                continue
+            for s in range(0, stacks):
+                sums[s] += panel._data[s][i + j]
+        for s in range(0, stacks):
+            panel._sdata[s][i] = sums[s] / n if n > 0 else 0
+    return
+
+
+def check_move_mean(lengths=PANEL_LENGTHS, tol=1, stacks=2):
+    """Compare LaserCtrl._cal_move_mean against the float ref_move_mean
+
+    Returns the largest difference in um, raises AssertionError when it is
+    over tol.
+    """
+    new = Panel(12.0, stacks=stacks)
+    worst = 0.0
+    for n in lengths:
+        for seed in range(1, 4):
+            fill_panel(new, n, seed)
+            ref = _RefPanel(new)
+            ref_move_mean(ref)
+            LaserCtrl._cal_move_mean(None, new)
+            assert ref.s_in == new.s_in, "s_in %d != %d" % (ref.s_in, new.s_in)
+            for s in range(0, stacks):
+                b = s * MAX_PANEL_DATA
+                for i in range(0, ref.s_in):
+                    worst = max(worst,
+                                abs(ref._sdata[s][i] * UM_PER_MM - new._sdata[b + i]))
+    assert worst <= tol, "moving mean differs by %0.3fum" % worst
+    print("Moving mean parity: max diff %0.3fum" % worst)
+    return worst
+
+
+def check_online_filter(tol=0, stacks=2):
+    """Compare the online filter of Panel.add_points with the batch one
+
+    The batch window is _in // 20, so the panel is FILTER_SIZE * 20 long
+    for both to use the same window. The judgment, flatness included,
+    must match too.
+    """
+    n = FILTER_SIZE * 20
+    batch = fill_panel(Panel(12.0, online=False, stacks=stacks), n)
+    online = feed_panel(Panel(12.0, stacks=stacks), n)
+    LaserCtrl._cal_move_mean(None, batch)
+    LaserCtrl._judgment(None, batch)
+    LaserCtrl._judgment(None, online)
+    assert batch.s_in == online.s_in, "s_in %d != %d" % (batch.s_in, online.s_in)
+    worst = 0
+    for s in range(0, stacks):
+        for x, y in ((batch.diff, online.diff), (batch.std, online.std),
+                     (batch.flat, online.flat), (batch.slope, online.slope),
+                     (batch.worst, online.worst)):
+            worst = max(worst, abs(x[s] - y[s]))
+        b = s * MAX_PANEL_DATA
+        for i in range(b, b + batch.s_in):
+            worst = max(worst, abs(batch._sdata[i] - online._sdata[i]))
+    assert worst <= tol, "online filter differs by %dum" % worst
+    print("Online filter parity: max diff %dum" % worst)
+    return worst
+
+
+def check_backends(lengths=PANEL_LENGTHS, stacks=2):
+    """Compare the moving mean of the ulab backend with the Python one
+
+    The results must be the same to the um. Returns the number of samples
+    compared, None without ulab.
+    """
+    if laser_ctrl.np is None:
+        print("Backend parity: ulab not available")
+        return None
+    py = Panel(12.0, online=False, stacks=stacks)
+    ul = Panel(12.0, online=False, stacks=stacks)
+    backend = laser_ctrl.get_backend()
+    count = 0
+    try:
+        for n in lengths:
+            for seed in range(1, 4):
+                fill_panel(py, n, seed)
+                fill_panel(ul, n, seed)
+                laser_ctrl.set_backend(BACKEND_PYTHON)
+                LaserCtrl._cal_move_mean(None, py)
+                laser_ctrl.set_backend(BACKEND_ULAB)
+                LaserCtrl._cal_move_mean(None, ul)
+                assert py.s_in == ul.s_in, "s_in %d != %d" % (py.s_in, ul.s_in)
+                for s in range(0, stacks):
+                    b = s * MAX_PANEL_DATA
+                    for i in range(b, b + py.s_in):
+                        assert py._sdata[i] == ul._sdata[i], (
+                            "n=%d stack %d sample %d: %d != %d"
+                            % (n, s, i - b, py._sdata[i], ul._sdata[i]))
+                count += stacks * py.s_in
+    finally:
+        laser_ctrl.set_backend(backend)
+    print("Backend parity: %d samples equal" % count)
+    return count
+
+
+def check_spill_limit():
+    """Fill a spilling panel up to MAX_SPILL_DATA and write it
+
+    The sample after the limit must be refused, and the record must hold
+    exactly MAX_SPILL_DATA samples. Spills and writes to SD_FILE.
+    """
+    filename = SD_FILE + "/.bench_spill.bin"
+    panel = Panel(12.0, spill_dir=SD_FILE)
+    try:
+        feed_panel(panel, MAX_SPILL_DATA)
+        try:
+            panel.add_points([panel.th_um] * panel.stacks)
+        except IndexError:
+            pass
+        else:
+            raise AssertionError("Sample %d accepted" % (MAX_SPILL_DATA + 1))
+        assert panel._in == MAX_SPILL_DATA, "%d samples" % panel._in
+        LaserCtrl._judgment(None, panel)
+        f = open(filename, "wb")
+        try:
+            panel_format.write_panel(f, 1, panel)
+        finally:
+            f.close()
+        written = uos.stat(filename)[6]
+        size = panel_format.record_size(panel.stacks, MAX_SPILL_DATA)
+        assert written == size, "record %d bytes, not %d" % (written, size)
+    finally:
+        panel.close_spill()
+        try:
+            uos.remove(filename)
+        except OSError:
+            pass
+    print("Spill limit: %d samples written" % MAX_SPILL_DATA)
+    return panel._in
+
+
+def _time_us(f, panel, repeat):
+    best = None
+    for r in range(0, repeat):
+        t = utime.ticks_us()
+        f(panel)
+        delta = utime.ticks_diff(utime.ticks_us(), t)
+        if best is None or delta < best:
+            best = delta
+    return best
+
+
+def bench_move_mean(lengths=PANEL_LENGTHS, repeat=3):
+    """Time the reference and sliding window moving mean
+
+    Returns a list of (n, ref_us, new_us) with the best of repeat runs.
+    """
+    panel = Panel(12.0)
+    results = []
+    for n in lengths:
+        fill_panel(panel, n)
+        ref_us = _time_us(ref_move_mean, _RefPanel(panel), repeat)
+        new_us = _time_us(lambda p: LaserCtrl._cal_move_mean(None, p), panel, repeat)
+        print("n=%4d ref %9.3fms sliding %9.3fms" % (n, ref_us / 1000, new_us / 1000))
+        results.append((n, ref_us, new_us))
+    return results
+
+
+def bench_backends(lengths=PANEL_LENGTHS, repeat=3):
+    """Time the moving mean with the Python and the ulab backend
+
+    Returns a list of (n, python_us, ulab_us), ulab_us is None without
+    ulab.
+    """
+    panel = Panel(12.0, online=False)
+    backend = laser_ctrl.get_backend()
+    results = []
+    try:
+        for n in lengths:
+            fill_panel(panel, n)
+            times = []
+            for name in (BACKEND_PYTHON, BACKEND_ULAB):
+                if name == BACKEND_ULAB and laser_ctrl.np is None:
+                    times.append(None)
+                    continue
+                laser_ctrl.set_backend(name)
+                times.append(_time_us(lambda p: LaserCtrl._cal_move_mean(None, p),
+                                      panel, repeat))
+            if times[1] is None:
+                print("n=%4d python %9.3fms ulab  n/a" % (n, times[0] / 1000))
+            else:
+                print("n=%4d python %9.3fms ulab %9.3fms (x%0.1f)"
+                      % (n, times[0] / 1000, times[1] / 1000, times[0] / max(times[1], 1)))
+            results.append((n, times[0], times[1]))
+    finally:
+        laser_ctrl.set_backend(backend)
+    return results
+
+
+def bench_judgment(lengths=PANEL_LENGTHS, repeat=3):
+    """Time the judgment of a batch and of an online filtered panel
+
+    Returns a list of (n, batch_us, online_us).
+    """
+    batch = Panel(12.0, online=False)
+    online = Panel(12.0)
+    results = []
+    for n in lengths:
+        fill_panel(batch, n)
+        LaserCtrl._cal_move_mean(None, batch)
+        feed_panel(online, n)
+        batch_us = _time_us(lambda p: LaserCtrl._judgment(None, p), batch, repeat)
+        online_us = _time_us(lambda p: LaserCtrl._judgment(None, p), online, repeat)
+        print("n=%4d batch %9.3fms online %9.3fms" % (n, batch_us / 1000, online_us / 1000))
+        results.append((n, batch_us, online_us))
+    return results
+
+
+def bench_write_panel(laser, lengths=PANEL_LENGTHS, repeat=3, fmts=(FMT_BIN, FMT_TEXT)):
+    """Time LaserCtrl._write_panel to the SD card
+
+    Each format writes to a BENCH session file that is removed afterwards.
+    Returns a list of (n, fmt, us).
+    """
+    panel = Panel(12.0)
+    results = []
+    for fmt in fmts:
+        laser.start_session("BENCH", "12", fmt)
+        filename = SD_FILE + "/" + laser._session.get_filename()
+        try:
+            for n in lengths:
+                feed_panel(panel, n)
+                laser._judgment(panel)
+                us = _time_us(laser._write_panel, panel, repeat)
+                print("n=%4d %s %9.3fms" % (n, "bin " if fmt == FMT_BIN else "text", us / 1000))
+                results.append((n, fmt, us))
+        finally:
+            laser.end_session()
+            uos.remove(filename)
+    return results
+
+
+def bench_acquisition(laser, n=MAX_PANEL_DATA):
+    """Samples/s and jitter of the plain and the pipelined M0 loop
+
+    laser is a LaserCtrl with the amplifiers connected, the readings are
+    not checked. Returns a list of (pipeline, samples/s, std dev us, max
+    interval us).
+    """
+    panel = Panel(12.0, online=False)
+    results = []
+    for pipeline in (False, True):
+        if pipeline:
+            laser._start_stream()
+            read_pvs = laser._next_pvs
+        else:
+            read_pvs = laser.get_phrase_pvs
+        try:
+            panel.start_measure(read_pvs())
+            for i in range(1, n):
+                panel.add_points(read_pvs())
+        finally:
+            laser._stop_stream()
+        rate, mean, jitter, worst = panel.sample_stats()
+        print("%s %7.1f samples/s interval %7.1fus jitter %7.1fus max %dus"
+              % ("pipelined" if pipeline else "plain    ", rate, mean, jitter, worst))
+        results.append((pipeline, rate, jitter, worst))
+    return results
+
+
+M0_FRAME = b"M0,+06.012,+05.993,-99.999,+00.125\r\n"
+
+
+_ref_pvs = array('f', [0.0] * 4)
+_ref_cals = array('f', [0.0] * 2)
+
+
+def ref_parse_pvs(laser):
+    """The original slice and float() parse of an M0 reply of 4 amplifiers"""
+    for amp in range(0,4):
+        _ref_pvs[amp] = float(laser._read_buf[amp*8+3:amp*8+10])
+        if not amp % 2:
+            _ref_cals[amp//2] = _ref_pvs[amp]
+        else:
+            _ref_cals[amp//2] += _ref_pvs[amp]
+    return _ref_cals
+
+
+def _alloc(f, n):
+    # gc.mem_alloc only exists on MicroPython
+    if not hasattr(gc, "mem_alloc"):
+        return None
+    gc.collect()
+    gc.disable()
+    before = gc.mem_alloc()
+    for i in range(0, n):
+        f()
+    after = gc.mem_alloc()
+    gc.enable()
+    return (after - before) / n
+
+
+def bench_parse(n=1000):
+    """Bytes allocated and time per M0 parse, original vs in place
+
+    Run without the amplifiers, a fixed reply is parsed. Returns
+    ((ref_bytes, ref_us), (new_bytes, new_us)), bytes are None off the MCU.
+    """
+    laser = LaserCtrl.__new__(LaserCtrl)
+    laser._init_buffers(2)
+    laser._read_buf[:] = M0_FRAME
+    results = []
+    for name, f in (("slice+float", lambda: ref_parse_pvs(laser)),
+                    ("in place   ", lambda: laser._parse_pvs(frame_size(2)))):
+        per_call = _alloc(f, n)
+        t = utime.ticks_us()
+        for i in range(0, n):
+            f()
+        us = utime.ticks_diff(utime.ticks_us(), t) / n
+        if per_call is None:
+            print("%s %7.1fus" % (name, us))
+        else:
+            print("%s %7.1fus %6.1f bytes/sample" % (name, us, per_call))
+        results.append((per_call, us))
+    return results
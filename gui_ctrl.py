@@ -8,6 +8,7 @@ July 30, 2019
 import utime
 import _thread
 import gc
+from array import array
 
 import lvgl as lv
 from micropython import const
@@ -16,11 +17,140 @@ import TFTFeatherWing as tftwing
 
 import laser_mcu
 import laser_ctrl
+import utils
+from utils import profiled2
 
 
 DISP_BUF_SIZE = const(9600)
 MATERIAL_TYPE = ("WPC", "ECEL", "OTHER")
 THICKNESS_TYPE = ("12", "5", "5.5", "6.5")
+# Period of the task draining the sample ring while measuring, ms
+WAIT_PANEL_PERIOD = const(50)
+WIFI_POLL_PERIOD = const(500)
+# lv_chart skips points with this value (LV_CHART_POINT_DEF)
+CHART_NO_POINT = const(-32768)
+_CHART_MAX = const(32767)
+# Series colours of each stack, raw and moving mean
+RAW_COLORS = (0x0000b3, 0xe60000, 0xb300b3, 0x00b3b3)
+SMOOTH_COLORS = (0x00e600, 0xffffff, 0xe6e600, 0xe68a00)
+
+
+def _clip(d):
+    if d > _CHART_MAX:
+        return _CHART_MAX
+    if d < -_CHART_MAX:
+        return -_CHART_MAX
+    return d
+
+
+def decimate(panel, col, stack, n, n_ref, out):
+    """Reduce the first n samples of a panel column to the chart points out
+
+    With n_ref samples or fewer than points, each sample is a point.
+    Otherwise the n_ref samples are split in len(out) // 2 buckets and each
+    gives its min and max, in the order they occurred, so peaks stay
+    visible. n can be less than n_ref (the moving mean), its buckets
+    line up with the n_ref ones and the points after it are left empty.
+    Returns the number of points to show.
+    """
+    m = len(out)
+    i = 0
+    if n_ref <= m:
+        for chunk in panel.chunks(col, stack):
+            for d in chunk:
+                if i >= n:
+                    break
+                out[i] = _clip(d)
+                i += 1
+        for j in range(i, n_ref):
+            out[j] = CHART_NO_POINT
+        return n_ref
+    buckets = m // 2
+    b = 0
+    start = 0
+    end = n_ref // buckets
+    lo = hi = lo_i = hi_i = 0
+    for chunk in panel.chunks(col, stack):
+        for d in chunk:
+            if i >= n:
+                break
+            if i == start or d < lo:
+                lo = d
+                lo_i = i
+            if i == start or d > hi:
+                hi = d
+                hi_i = i
+            i += 1
+            if i == end:
+                # Min and max of the bucket in sample order
+                if lo_i > hi_i:
+                    lo, hi = hi, lo
+                out[2 * b] = _clip(lo)
+                out[2 * b + 1] = _clip(hi)
+                b += 1
+                start = end
+                end = (b + 1) * n_ref // buckets
+    if i > start:
+        # A shorter column ends inside a bucket
+        if lo_i > hi_i:
+            lo, hi = hi, lo
+        out[2 * b] = _clip(lo)
+        out[2 * b + 1] = _clip(hi)
+        b += 1
+    for j in range(2 * b, m):
+        out[j] = CHART_NO_POINT
+    return m
+
+
+class ChartData:
+    """Panel data adapter of the chart
+
+    Keeps one preallocated point buffer per series, one point per pixel
+    column. load() fills them from a panel, one pass per column, and hands
+    each to the chart whole with set_points. series are the raw series of
+    every stack followed by their moving mean series.
+    """
+
+    def __init__(self, chart, series):
+        self._chart = chart
+        self._series = series
+        width = chart.get_width() & ~1
+        self._bufs = [array('h', [CHART_NO_POINT] * width) for ser in series]
+        self._n = 0
+        return
+
+    def set_range(self, th_um, span_um=1000):
+        self._chart.set_range(th_um - span_um, th_um + span_um)
+        return
+
+    def clear(self, y=CHART_NO_POINT):
+        """Empty every series, or set every point to y"""
+        for ser in self._series:
+            self._chart.init_points(ser, y)
+        return
+
+    def load(self, panel, smoothed=True):
+        """Plot the raw columns of a panel, and the moving mean if smoothed
+
+        Series left out are emptied, so nothing of the last panel stays.
+        """
+        # Panel data is in um, the chart unit
+        n = panel._in - panel.filter_size() // 2
+        bufs = self._bufs
+        stacks = len(self._series) // 2
+        m = 0
+        for s in range(0, stacks):
+            m = decimate(panel, laser_ctrl.COL_DATA, s, n, n, bufs[s])
+            if smoothed:
+                # Same buckets as the raw data, so the series line up
+                decimate(panel, laser_ctrl.COL_SDATA, s, panel.s_in, n, bufs[stacks + s])
+        self._chart.set_point_count(m)
+        for i in range(0, len(self._series)):
+            if i < stacks or smoothed:
+                self._chart.set_points(self._series[i], bufs[i])
+            else:
+                self._chart.init_points(self._series[i], CHART_NO_POINT)
+        return
 
 
 class LaserGui:
@@ -29,6 +159,7 @@ class LaserGui:
     def __init__(self):
         # init LVGL
         lv.init()
+        utils.boot_mark("lvgl")
         # TFT and TS driver
         # POTENTIAL: move into LaserMcu
         self._tft = tftwing.TFTFeatherWing(tft_mhz=24)
@@ -40,34 +171,53 @@ class LaserGui:
         lv.theme_set_current(th)
         blank_scr = lv.obj()
         lv.scr_load(blank_scr)
-        # MCU Control
+        utils.boot_mark("display")
+        # MCU Control, the SD card, TH sensor and WiFi come up after the
+        # first frame, see _late_init_cb
         self.mcu = laser_mcu.LaserMCU()
+        utils.boot_mark("mcu")
         # Laser Measuring Control
         self.laser = laser_ctrl.LaserCtrl()
-        self.laser.off()
-        # Load Time
-        # TODO: also move into LaserMcu
+        self.laser.start_worker()
         try:
-            self.mcu.set_time_ntp()
+            self.laser.off()
         except OSError as err:
-            print("OSError: {0}".format(err))
+            # Measuring turns them on and reports a missing amplifier
+            print("Laser off: {0}".format(err))
+        utils.boot_mark("laser")
+        # Load Time, NTP corrects it once the WiFi is up
+        try:
             self.mcu.load_time()
+        except (OSError, ValueError) as err:
+            print("Load time: {0}".format(err))
         self.mcu.set_creation_time()
+        utils.boot_mark("time")
         # Create screen
         self._load_screen()
+        utils.boot_mark("screen")
         # Register Tasks
         self._register_tasks()
+        utils.boot_mark("tasks")
         # Create lock for panel wait process
         self._lock = _thread.allocate_lock()
         return
 
     def _register_tasks(self):
+        # Runs once, after the display refresh drew the first frame
+        self._task_late_init = lv.task_create(None, 0, lv.TASK_PRIO.LOWEST, None)
+        lv.task_set_cb(self._task_late_init, self._late_init_cb)
         # Task to update th
         self._task_update_th = lv.task_create(None, 1000, lv.TASK_PRIO.MID, None)
         lv.task_set_cb(self._task_update_th, self._update_th_cb)
         # Task to save th
         self._task_save_th = lv.task_create(None, 60000, lv.TASK_PRIO.MID, None)
         lv.task_set_cb(self._task_save_th, self._save_th_cb)
+        # Task to upload the TH and panel records
+        self._task_upload = lv.task_create(None, 60000, lv.TASK_PRIO.MID, None)
+        lv.task_set_cb(self._task_upload, self._upload_cb)
+        # Task to keep the WiFi up
+        self._task_wifi = lv.task_create(None, WIFI_POLL_PERIOD, lv.TASK_PRIO.MID, None)
+        lv.task_set_cb(self._task_wifi, self._wifi_cb)
         # Task to update time
         self._task_update_time = lv.task_create(None, 1000, lv.TASK_PRIO.MID, None)
         lv.task_set_cb(self._task_update_time, self._update_time_cb)
@@ -81,7 +231,7 @@ class LaserGui:
         self._task_update_laser_output = lv.task_create(None, 200, lv.TASK_PRIO.OFF, None)
         lv.task_set_cb(self._task_update_laser_output, self._update_laser_output_cb)
         # Task to wait for wait panel function
-        self._task_wait_panel = lv.task_create(None, 1000, lv.TASK_PRIO.OFF, None)
+        self._task_wait_panel = lv.task_create(None, WAIT_PANEL_PERIOD, lv.TASK_PRIO.OFF, None)
         lv.task_set_cb(self._task_wait_panel, self._check_wait_panel_cb)
         return
     
@@ -95,27 +245,20 @@ class LaserGui:
         lv.scr_load(self.scr)        
         return
 
+    @profiled2
     def _check_wait_panel_cb(self, data):
-        if not self._lock.locked():
-            # Restart tasks
+        # Takes the samples out of the ring, judges and writes the panel
+        # once the acquisition thread is done
+        if self.laser.process():
             lv.task_set_prio(self._task_wait_panel, lv.TASK_PRIO.OFF)
-            lv.task_set_prio(self._task_update_time, lv.TASK_PRIO.MID)
-            lv.task_set_prio(self._task_update_th, lv.TASK_PRIO.MID)
-            lv.task_set_prio(self._task_gc_collect, lv.TASK_PRIO.MID)            
             # Show Session
             self.body._session.set_hidden(False)
             self.body._re_measure_btn.set_hidden(False) 
             self.body._preload_cont.set_hidden(True)
             # Plot data
-            # TODO set chart y range
-            # TODO empty old chart
             panel = self.laser._session.panel
-            filter_size = panel._in // 20
-            self.body._chart.set_point_count(panel._in)
-            for d in panel._data1[0:panel._in - filter_size // 2]:
-                self.body._chart.set_next(self.body._ser1, int(d*1000))
-            for d in panel._data2[0:panel._in - filter_size // 2]:
-                self.body._chart.set_next(self.body._ser2, int(d*1000))
+            self.body._chart_data.load(panel, panel.err is None)
+            self.mcu.uploader.add("/panel/", self.laser._session.result_json())
             # TODO set warning label and text
             if panel.err is not None:
                 self.body._start_measure_btn.set_hidden(True)
@@ -125,43 +268,86 @@ class LaserGui:
                 self.body._start_measure_btn.set_hidden(False)
                 self.body._session_label.set_text(str(self.laser._session)
                                                   + "\nDiff: "
-                                                  + ("%0.3f" % panel.diff1)
-                                                  + "mm("
-                                                  + ("%0.3f" % (panel.diff1 / 25.4))
-                                                  + "in), "
-                                                  + ("%0.3f" % panel.diff2)
-                                                  + "mm("
-                                                  + ("%0.3f" % (panel.diff2 / 25.4))
-                                                  + "in)"
+                                                  + ", ".join(["%0.3fmm(%0.3fin)"
+                                                               % (d / 1000, d / 25400)
+                                                               for d in panel.diff])
                 )
-                for d in panel._sdata1[0:panel.s_in]:
-                    self.body._chart.set_next(self.body._ser3, int(d*1000))
-                for d in panel._sdata2[0:panel.s_in]:
-                    self.body._chart.set_next(self.body._ser4, int(d*1000))
-                if panel.good:
-                    self.mcu.alt()
-                else:
-                    self.mcu.warn()
+        return
+
+    def _panel_judged_cb(self, panel):
+        # Called from the measuring thread, sound while the panel is still here
+        if panel.err is None:
+            if panel.good:
+                self.mcu.alt()
+            else:
+                self.mcu.warn()
         return
         
+    @profiled2
     def _update_time_cb(self, data):
-        if self.mcu.is_connected():
+        state = self.mcu.wifi.state
+        if state == laser_mcu.WIFI_UP:
+            self.hdr.set_left_text(self.mcu.get_lt_str() + " " + lv.SYMBOL.WIFI)
+        elif state == laser_mcu.WIFI_CONNECTING and utime.time() % 2:
+            # Blinks while connecting
             self.hdr.set_left_text(self.mcu.get_lt_str() + " " + lv.SYMBOL.WIFI)
         else:
             self.hdr.set_left_text(self.mcu.get_lt_str())
         return
 
+    def _late_init_cb(self, data):
+        lv.task_del(self._task_late_init)
+        utils.boot_mark("first_frame")
+        self.mcu.late_init()
+        utils.boot_dump()
+        try:
+            utils.boot_dump(laser_mcu.SD_FILE + laser_mcu.BOOT_FILE)
+        except OSError as err:
+            print("OSError: {0}".format(err))
+        return
+
+    def _wifi_cb(self, data):
+        self.mcu.poll_wifi()
+        return
+
+    @profiled2
     def _save_th_cb(self, data):
-        self.mcu.save_th_data()
+        try:
+            self.mcu.save_th_data()
+        except (OSError, RuntimeError) as err:
+            print("TH not saved: {0}".format(err))
         return
     
+    @profiled2
+    def _upload_cb(self, data):
+        if self._lock.locked():
+            # A slow server must not hold up the panel being measured
+            return
+        self.mcu.uploader.flush()
+        return
+
+    @profiled2
     def _update_th_cb(self, data):
-        self.hdr.set_right_text(self.mcu.get_th_str())
+        # Never waits on I2C, shows the conversion started last tick
+        try:
+            self.mcu.poll_th()
+            th_str = self.mcu.get_th_str()
+        except (OSError, RuntimeError) as err:
+            # Keep the last string, the next tick tries again
+            print("TH sensor: {0}".format(err))
+            return
+        self.hdr.set_right_text(th_str)
         return
     
+    @profiled2
     def _update_laser_output_cb(self, data):
+        cache = self.laser.pvs_cache
+        if self._lock.locked() and not cache.fresh():
+            # The acquisition thread has the amplifiers, its readings
+            # refresh the cache unless it is stuck
+            return
         try:
-            self.laser.get_phrase_pvs()     
+            cache.get()
         except:
             return
         pv_str = self.laser.get_values_str()  
@@ -336,10 +522,12 @@ class GuiLaserMain(lv.tabview):
         self._chart.set_height(90)
         self._chart.set_point_count(700)
         self._chart.set_range(11000,13000)
-        self._ser1 = self._chart.add_series(lv.color_hex(0x0000b3))
-        self._ser2 = self._chart.add_series(lv.color_hex(0xe60000))
-        self._ser3 = self._chart.add_series(lv.color_hex(0x00e600))       
-        self._ser4 = self._chart.add_series(lv.color_hex(0xffffff))
+        stacks = gui_ctrl.laser.stacks
+        series = []
+        for colors in (RAW_COLORS, SMOOTH_COLORS):
+            for s in range(0, stacks):
+                series.append(self._chart.add_series(lv.color_hex(colors[s % len(colors)])))
+        self._chart_data = ChartData(self._chart, series)
 
         self._session.set_hidden(True)
         
@@ -360,13 +548,16 @@ class GuiLaserMain(lv.tabview):
         self._cal_num_input.set_auto_realign(True)
         self._cal_num_input.align(self._cal_label, lv.ALIGN.OUT_BOTTOM_LEFT, 0, 0)
 
-        self._set_cal_1 = TextBtn(self._t_cal, "Set Amp 1", self._set_amp_1_cb)
-        self._set_cal_1.set_style(lv.btn.STYLE.REL, btn_style_or)
-        self._set_cal_1.align(self._cal_num_input, lv.ALIGN.OUT_RIGHT_MID, 0, 0)
-
-        self._set_cal_2 = TextBtn(self._t_cal, "Set Amp 2", self._set_amp_2_cb)
-        self._set_cal_2.set_style(lv.btn.STYLE.REL, btn_style_or)
-        self._set_cal_2.align(self._set_cal_1, lv.ALIGN.OUT_RIGHT_MID, 0, 0)
+        # One button per stack, in a row right of the input
+        self._set_cal = []
+        prev = self._cal_num_input
+        for s in range(0, stacks):
+            btn = TextBtn(self._t_cal, "Set Amp %d" % (s + 1),
+                          lambda obj, event, s=s: self._set_amp_cb(s, obj, event))
+            btn.set_style(lv.btn.STYLE.REL, btn_style_or)
+            btn.align(prev, lv.ALIGN.OUT_RIGHT_MID, 0, 0)
+            self._set_cal.append(btn)
+            prev = btn
         
         self._kb = lv.kb(self._t_cal)
         self._kb.set_map(["1", "2", "3","\n","4","5", "6",\
@@ -386,13 +577,11 @@ class GuiLaserMain(lv.tabview):
     def _start_measure_cb(self, obj, event):
         if event == lv.EVENT.CLICKED:
             panel = self._gui_ctrl.laser._session.new_panel()
-            _thread.start_new_thread(self._gui_ctrl.laser.wait_for_panel,
-                                     [panel,
-                                      self._gui_ctrl._lock]
-            )
-            lv.task_set_prio(self._gui_ctrl._task_update_time, lv.TASK_PRIO.OFF)
-            lv.task_set_prio(self._gui_ctrl._task_update_th, lv.TASK_PRIO.OFF)
-            lv.task_set_prio(self._gui_ctrl._task_gc_collect, lv.TASK_PRIO.OFF)
+            # The other tasks keep running, the acquisition thread only
+            # fills the sample ring
+            self._gui_ctrl.laser.measure(panel,
+                                         self._gui_ctrl._lock,
+                                         self._gui_ctrl._panel_judged_cb)
             self._session.set_hidden(True)
             self._preload_cont.set_hidden(False)
             lv.task_set_prio(self._gui_ctrl._task_wait_panel, lv.TASK_PRIO.MID)
@@ -401,13 +590,11 @@ class GuiLaserMain(lv.tabview):
     def _re_measure_cb(self, obj, event):
         if event == lv.EVENT.CLICKED:
             panel = self._gui_ctrl.laser._session.re_panel()
-            _thread.start_new_thread(self._gui_ctrl.laser.wait_for_panel,
-                                     [panel,
-                                      self._gui_ctrl._lock]
-            )
-            lv.task_set_prio(self._gui_ctrl._task_update_time, lv.TASK_PRIO.OFF)
-            lv.task_set_prio(self._gui_ctrl._task_update_th, lv.TASK_PRIO.OFF)
-            lv.task_set_prio(self._gui_ctrl._task_gc_collect, lv.TASK_PRIO.OFF)
+            # The other tasks keep running, the acquisition thread only
+            # fills the sample ring
+            self._gui_ctrl.laser.measure(panel,
+                                         self._gui_ctrl._lock,
+                                         self._gui_ctrl._panel_judged_cb)
             self._session.set_hidden(True)
             self._preload_cont.set_hidden(False)
             lv.task_set_prio(self._gui_ctrl._task_wait_panel, lv.TASK_PRIO.MID)
@@ -421,6 +608,16 @@ class GuiLaserMain(lv.tabview):
     def _done_measure(self):
         self._gui_ctrl.laser.end_session()
         self._gui_ctrl.laser.off()         
+        try:
+            # The operator may switch off after a session
+            self._gui_ctrl.mcu.flush_th()
+        except OSError as err:
+            print("OSError: {0}".format(err))
+        if utils.prof_enabled():
+            try:
+                utils.prof_dump(laser_mcu.SD_FILE + laser_mcu.PROF_FILE)
+            except OSError as err:
+                print("OSError: {0}".format(err))
         self._new_sess.set_hidden(False)
         self._preload_cont.set_hidden(True)
         self._session.set_hidden(True)
@@ -431,32 +628,22 @@ class GuiLaserMain(lv.tabview):
             material = MATERIAL_TYPE[self._material_sel.get_selected()]
             thickness = THICKNESS_TYPE[self._thickness_sel.get_selected()]
             self._gui_ctrl.laser.on()
+            # Sessions are written to the SD card
+            self._gui_ctrl.mcu.mount_sd()
             self._gui_ctrl.laser.start_session(material, thickness)
             self._session_label.set_text(str(self._gui_ctrl.laser._session))
-            self._chart.set_range(int((float(thickness) - 1)*1000),int((float(thickness) + 1)*1000))     
-            self._chart.init_points(self._ser1, int(float(thickness)*1000))
-            self._chart.init_points(self._ser2, int(float(thickness)*1000))
-            self._chart.init_points(self._ser3, int(float(thickness)*1000))
-            self._chart.init_points(self._ser4, int(float(thickness)*1000))       
+            self._chart_data.set_range(int(float(thickness)*1000))
+            self._chart_data.clear()
             self._new_sess.set_hidden(True)
             self._session.set_hidden(False)
             self._re_measure_btn.set_hidden(True) 
         return
     
-    def _set_amp_1_cb(self, obj, event):
-        if event == lv.EVENT.CLICKED:
-            try:
-                self._gui_ctrl.laser.zero_shift(0, float(self._cal_num_input.get_text()))
-                self._cal_label.set_text("Setting Amp 1")
-            except ValueError:
-                print("Not a float")
-        return
-    
-    def _set_amp_2_cb(self, obj, event):
+    def _set_amp_cb(self, stack, obj, event):
         if event == lv.EVENT.CLICKED:
             try:
-                self._gui_ctrl.laser.zero_shift(1, float(self._cal_num_input.get_text()))
-                self._cal_label.set_text("Setting Amp 2")
+                self._gui_ctrl.laser.zero_shift(stack, float(self._cal_num_input.get_text()))
+                self._cal_label.set_text("Setting Amp %d" % (stack + 1))
             except ValueError:
                 print("Not a float")
         return
@@ -476,6 +663,12 @@ class GuiLaserMain(lv.tabview):
                 else:         
                     lv.task_set_prio(self._gui_ctrl._task_update_laser_output, lv.TASK_PRIO.OFF)
                     self._gui_ctrl.laser.off()
+                if tab_act == 3:
+                    # Done, the unit may be switched off from here
+                    try:
+                        self._gui_ctrl.mcu.shutdown()
+                    except OSError as err:
+                        print("Shutdown: {0}".format(err))
         return
     
     def ta_test(self, obj, event):
@@ -7,23 +7,70 @@ Controller for the laser sensor
 """
 import utime
 import ujson
+import uselect
 import _thread
 from array import array
 
+try:
+    from uerrno import ETIMEDOUT
+except ImportError:
+    from errno import ETIMEDOUT
+
+try:
+    # Firmware built with ulab 2.0 or later
+    from ulab import numpy as np
+except ImportError:
+    np = None
+
 from machine import UART
 from micropython import const
 
 from laser_mcu import TIME_ZONE_OFFSET, SD_FILE
-from utils import timed_function
+from utils import timed_function, profiled, profiled2, prof_register, prof_add, SensorCache
+import panel_format
+from panel_format import FMT_TEXT, FMT_BIN
 
 
 DEFAULT_PANEL_WIDTH_MM = const(1245)
-MAX_AMP_NUM = const(4)
-READ_BUF_SIZE = const(36)
+# Thickness stacks across the panel width. A stack is a pair of
+# amplifiers, above and below the panel, whose readings add up to the
+# thickness; amplifier 2s and 2s+1 are stack s.
+STACKS = const(2)
+MAX_STACKS = const(8)
+AMPS_PER_STACK = const(2)
 MAX_PANEL_DATA = const(600)
+# Longest panel when spilling to SD, the record count is 16 bit
+MAX_SPILL_DATA = const(65535)
 PANEL_WAIT_TIMEOUT = const(30000)
+# Oldest reading the calibration tab takes from pvs_cache
+PVS_MAX_AGE = const(200)
+# Samples between the acquisition thread and the consumer, a power of 2.
+# At ~80 samples/s the consumer may fall 3 s behind
+RING_SIZE = const(256)
+# Reply deadlines in ms, a 36 byte M0 reply takes ~10ms at 38400 baud
+REPLY_TIMEOUT = const(100)
+CMD_TIMEOUT = const(500)
+# M0 attempts of the boot probe
+PROBE_TRIES = const(3)
+LINE_BUF_SIZE = const(64)
+# Readings are kept as integer thousandths of a mm (um) from the M0 reply
+# to the SD card, floats are only made for display and text export
+UM_PER_MM = const(1000)
 DATA_DIV = const(1)
-JUDGMENT_VALUE = 0.5
+DATA_DIV_UM = const(DATA_DIV * UM_PER_MM)
+# Moving mean window used while measuring, the length is not known yet
+FILTER_SIZE = const(30)
+JUDGMENT_VALUE_UM = const(500)
+# Array maths of the batch moving mean, see set_backend()
+BACKEND_PYTHON = "python"
+BACKEND_ULAB = "ulab"
+# Panel.chunks() columns, the data ones per stack
+COL_TIME = const(0)
+COL_DATA = const(1)
+COL_SDATA = const(2)
+# Profiler slots of the acquisition loop, see utils.prof_add
+_PROF_READ = prof_register("acq_read_pvs")
+_PROF_ADD = prof_register("acq_add_points")
 
 _ZERO_SHIFT = "001"
 _RESET = "003"
@@ -36,18 +83,245 @@ _ZERO_SHIFT_MEM = "152"
 _POWER_SAVE = "155"
 
 
+def _fixed3(buf, i):
+    """Fixed width "+DD.DDD" at buf[i] in thousandths
+
+    Digits are read in place, nothing is allocated unless the field is
+    malformed, then ValueError is raised.
+    """
+    v = 0
+    for k in range(i + 1, i + 7):
+        if k == i + 3:
+            if buf[k] != 46:
+                raise ValueError("Bad M0 value")
+            continue
+        d = buf[k] - 48
+        if d < 0 or d > 9:
+            raise ValueError("Bad M0 value")
+        v = v * 10 + d
+    if buf[i] == 45:
+        return -v
+    if buf[i] != 43:
+        raise ValueError("Bad M0 value")
+    return v
+
+
+def _div_round(a, n):
+    """a / n rounded to the nearest integer, n > 0"""
+    return (2 * a + n) // (2 * n)
+
+
+_backend = BACKEND_PYTHON if np is None else BACKEND_ULAB
+
+
+def set_backend(name):
+    """Select the moving mean maths, BACKEND_ULAB is the default with ulab
+
+    Both give the same results, BACKEND_PYTHON is there for firmware
+    without ulab and to check the two against each other. Only the batch
+    filter of online=False panels uses it. Sessions measure online
+    panels, their filter takes one sample at a time in add_points() and
+    has nothing to vectorise, so the backend does not change them.
+    """
+    global _backend
+    if name == BACKEND_ULAB and np is None:
+        raise ValueError("ulab not available")
+    if name not in (BACKEND_PYTHON, BACKEND_ULAB):
+        raise ValueError("Unknown backend %s" % name)
+    _backend = name
+    return
+
+
+def get_backend():
+    return _backend
+
+
+def _move_mean_ulab(panel, filter_size):
+    """LaserCtrl._cal_move_mean with ulab ndarrays, the same integer results
+
+    The windows are a convolution of the in range samples with ones. The
+    samples are um offsets from thickness and a window sums at most
+    filter_size of them, so the float sums, and the rounding of their
+    mean, are exact even in single precision. The means are stored
+    through a uint16 view of _sdata, as the low half of each little
+    endian int32 with the high half 0, ulab has no int32. That holds
+    means up to 65535um, thicker panels are stored one at a time.
+    """
+    n_in = panel._in
+    s_in = panel.s_in
+    th = panel.th_um
+    if s_in <= 0:
+        return
+    data = memoryview(panel._data)
+    sdata = panel._sdata
+    ones = np.ones(filter_size, dtype=np.float)
+    offsets = []
+    ok = np.ones(n_in, dtype=np.float)
+    for s in range(0, panel.stacks):
+        b = s * MAX_PANEL_DATA
+        d = np.array(data[b:b + n_in], dtype=np.float) - th
+        # A sample counts only if every stack is in range
+        ok = ok * (d >= -DATA_DIV_UM) * (d <= DATA_DIV_UM)
+        offsets.append(d)
+    # Window o is samples o..o+filter_size-1, full convolution index
+    # o+filter_size-1
+    w0 = filter_size - 1
+    n = np.convolve(ok, ones)[w0:w0 + s_in]
+    full = n > 0
+    # _div_round, an empty window gives 0 and is not divided by
+    div = 2 * n + (n == 0)
+    for s in range(0, panel.stacks):
+        sums = np.convolve(offsets[s] * ok, ones)[w0:w0 + s_in]
+        mean = (np.floor((2 * sums + n) / div) + th) * full
+        b = s * MAX_PANEL_DATA
+        if th + DATA_DIV_UM > 0xffff:
+            for i in range(0, s_in):
+                sdata[b + i] = int(mean[i])
+            continue
+        words = np.frombuffer(sdata, dtype=np.uint16, count=2 * s_in, offset=4 * b)
+        words[0::2] = np.array(mean, dtype=np.uint16)
+        words[1::2] = 0
+    return
+
+
+def frame_size(stacks):
+    """Length of the M0 reply of stacks stacks, 8 bytes per amplifier"""
+    return 4 + 8 * AMPS_PER_STACK * stacks
+
+
+def _any_below(a, v):
+    for i in range(0, len(a)):
+        if a[i] < v:
+            return True
+    return False
+
+
+def _any_above(a, v):
+    for i in range(0, len(a)):
+        if a[i] > v:
+            return True
+    return False
+
+
+def _in_range(data, i, stacks, lo, hi):
+    """True if sample i of every stack in the Panel layout data is in lo..hi"""
+    for s in range(0, stacks):
+        d = data[s * MAX_PANEL_DATA + i]
+        if d < lo or d > hi:
+            return False
+    return True
+
+
+def _emit_mean(sdata, o, sums, n, th, stacks):
+    """Moving mean output o of every stack, 0 for an empty window"""
+    for s in range(0, stacks):
+        sdata[s * MAX_PANEL_DATA + o] = th + _div_round(sums[s], n) if n > 0 else 0
+    return
+
+
+class LaserLink:
+    """Poll driven request/reply transport to the amplifiers
+
+    Waiting is done in uselect poll, which yields to other threads instead
+    of spinning. A reply is complete at its line end or when the buffer is
+    full; OSError(ETIMEDOUT) is raised if it is not complete by the
+    deadline.
+    """
+
+    def __init__(self, uart):
+        self._uart = uart
+        self._poll = uselect.poll()
+        self._poll.register(uart, uselect.POLLIN)
+        self._line_buf = bytearray(LINE_BUF_SIZE)
+        return
+
+    def send(self, cmd, flush=True):
+        # Drop what is left of an earlier reply that timed out
+        while flush and self._uart.any():
+            self._uart.read()
+        self._uart.write(cmd)
+        return
+
+    def recv_into(self, buf, timeout):
+        """Read one reply into buf, returns the number of bytes read"""
+        mv = memoryview(buf)
+        got = 0
+        size = len(buf)
+        deadline = utime.ticks_add(utime.ticks_ms(), timeout)
+        while True:
+            if self._uart.any():
+                n = self._uart.readinto(mv[got:])
+                if n:
+                    got += n
+                    if got == size or buf[got - 1] == 10:
+                        return got
+            remaining = utime.ticks_diff(deadline, utime.ticks_ms())
+            if remaining <= 0:
+                raise OSError(ETIMEDOUT)
+            for ev in self._poll.ipoll(remaining):
+                pass
+
+    def request(self, cmd, buf, timeout):
+        self.send(cmd)
+        return self.recv_into(buf, timeout)
+
+    def command(self, cmd, timeout=CMD_TIMEOUT):
+        """Send a settings command, returns the reply line as bytes"""
+        n = self.request(cmd, self._line_buf, timeout)
+        return bytes(self._line_buf[0:n])
+
+
 class LaserCtrl:
 
-    def __init__(self):
+    def __init__(self, stacks=STACKS):
         self._laser = UART(2)
         self._laser.init(baudrate=38400)
-        self._read_buf = bytearray("0" * READ_BUF_SIZE)
-        self._pvs = array('f', [0.0] * MAX_AMP_NUM)
-        self._cals = array('f', [0.0] * (MAX_AMP_NUM // 2))
+        self._link = LaserLink(self._laser)
+        self._init_buffers(stacks)
         self._laser_on = True
+        # Keep the next M0 in flight while a reply is parsed. Off by
+        # default, it only overlaps the parse and adds jitter, see
+        # bench.bench_acquisition()
+        self.pipeline = False
+        self._in_flight = False
         self._session = None
         self._sess_f = None
-        self.get_phrase_pvs()
+        # Acquisition thread and the panel it measures, see measure()
+        self.ring = SampleRing(RING_SIZE, stacks)
+        self._ps = array('i', [0] * stacks)
+        self._job = None
+        self._job_lock = None
+        self._panel = None
+        self._judged_cb = None
+        self._acq_done = True
+        self.probe()
+        return
+
+    def probe(self):
+        """Read the amplifiers at boot, returns True if they answered
+
+        Failed attempts are printed and not raised, so a slow or missing
+        amplifier does not stop the boot. Only measuring raises them.
+        """
+        for i in range(0, PROBE_TRIES):
+            try:
+                self.get_phrase_pvs()
+                return True
+            except (OSError, ValueError) as err:
+                print("Laser probe: {0}".format(err))
+        return False
+
+    def _init_buffers(self, stacks):
+        if not 0 < stacks <= MAX_STACKS:
+            raise ValueError("1 to %d stacks" % MAX_STACKS)
+        self.stacks = stacks
+        self._amps = stacks * AMPS_PER_STACK
+        self._read_buf = bytearray(b"0" * frame_size(stacks))
+        # Readings in um, per amplifier and per stack
+        self._pvs = array('i', [0] * self._amps)
+        self._cals = array('i', [0] * stacks)
+        # Every parsed M0 reply refreshes it, measuring included
+        self.pvs_cache = SensorCache("pvs_cache", self.get_phrase_pvs, PVS_MAX_AGE)
         return
 
     def reset_all(self):
@@ -59,58 +333,101 @@ class LaserCtrl:
     def get_values_str(self):
         pv_str = ""
         for pv in self._pvs:
-            pv_str += ("% 07.3f " % pv)
+            pv_str += ("% 07.3f " % (pv / UM_PER_MM))
         pv_str += '\n'
         for cal in self._cals:
-            pv_str += ("% 07.3f " % cal)
+            pv_str += ("% 07.3f " % (cal / UM_PER_MM))
         return pv_str
 
     def zero_shift(self, stack_num, ref):
-        amp = stack_num*2 + 1
+        amp = stack_num*AMPS_PER_STACK + 1
+        # Shift against a recent reading
+        self.pvs_cache.get()
         # Without the _ZERO_SHIFT_MEM shift will be forgotten after power cycle
         self.write_amp(amp, _ZERO_SHIFT_MEM, "1")
-        self.write_amp(amp, _SHIFT_VALUE, "%+07.3f" % (ref - self._pvs[stack_num*2]))
+        self.write_amp(amp, _SHIFT_VALUE, "%+07.3f" % (ref - self._pvs[stack_num*AMPS_PER_STACK] / UM_PER_MM))
         self.write_amp(amp, _ZERO_SHIFT, "0")
         self.write_amp(amp, _ZERO_SHIFT, "1")
         self.write_amp(amp, _ZERO_SHIFT_MEM, "0")
         return
 
-    def get_phrase_pvs(self):
-        self._laser.write("M0\r\n")
-        while not self._laser.any():
-            pass
-        self._laser.readinto(self._read_buf)
-        for amp in range(0,MAX_AMP_NUM):
+    def get_phrase_pvs(self, timeout=REPLY_TIMEOUT):
+        """Read all amplifiers, returns the stack thickness array in um
+
+        Raises OSError(ETIMEDOUT) if the reply is late and ValueError if it
+        can not be parsed.
+        """
+        n = self._link.request("M0\r\n", self._read_buf, timeout)
+        return self._parse_pvs(n)
+
+    def _start_stream(self):
+        """Start pipelined reading, one M0 is kept in flight"""
+        self._link.send("M0\r\n")
+        self._in_flight = True
+        return
+
+    def _next_pvs(self, timeout=REPLY_TIMEOUT):
+        """Pipelined get_phrase_pvs
+
+        The reply of the request in flight is read and the next M0 is sent
+        before parsing, so the amplifiers answer while this one is parsed
+        and stored. The next reply waits in the UART receive buffer.
+        """
+        n = self._link.recv_into(self._read_buf, timeout)
+        self._link.send("M0\r\n", False)
+        return self._parse_pvs(n)
+
+    def _stop_stream(self):
+        if self._in_flight:
+            self._in_flight = False
+            # Collect the last reply so it is not taken for the next one
             try:
-                self._pvs[amp] = float(self._read_buf[amp*8+3:amp*8+10])
-            except ValueError:
-                print(self._read_buf.decode("ascii"))
-                return
-            if not amp % 2:
-                self._cals[amp//2] = self._pvs[amp]
+                self._link.recv_into(self._read_buf, REPLY_TIMEOUT)
+            except OSError:
+                pass
+        return
+
+    def _parse_pvs(self, n):
+        """Parse the n byte M0 reply in _read_buf into _pvs and _cals
+
+        The reply is "M0,+DD.DDD,+DD.DDD,...\\r\\n", one pass over the fields
+        of all amplifiers reads them in place with _fixed3, stores them
+        as um and adds up each stack, nothing is allocated. Raises
+        ValueError on a bad frame.
+        """
+        buf = self._read_buf
+        end = self._amps * 8 + 2
+        if (n != end + 2 or buf[0] != 77 or buf[1] != 48
+            or buf[end] != 13 or buf[end + 1] != 10):
+            print(buf.decode("ascii"))
+            raise ValueError("Bad M0 frame")
+        pvs = self._pvs
+        cals = self._cals
+        i = 2
+        for amp in range(0, self._amps):
+            if buf[i] != 44:
+                print(buf.decode("ascii"))
+                raise ValueError("Bad M0 frame")
+            v = _fixed3(buf, i + 1)
+            pvs[amp] = v
+            if amp & 1:
+                cals[amp >> 1] += v
             else:
-                self._cals[amp//2] += self._pvs[amp]
+                cals[amp >> 1] = v
+            i += 8
+        self.pvs_cache.put(self._cals)
         return self._cals
 
     def write_all(self, cmd, data):
-        self._laser.write("AW,%s,%s\r\n" % (cmd, data))
-        while not self._laser.any():
-            utime.sleep_us(1)
-        self._laser.readline()
+        self._link.command("AW,%s,%s\r\n" % (cmd, data))
         return
 
     def read_all(self, cmd):
-        for amp in range(0,MAX_AMP_NUM):
-            self._laser.write("SR,%02d,%s\r\n" % (amp, cmd))
-            while not self._laser.any():
-                utime.sleep_us(1)
-            print(self._laser.readline())
+        for amp in range(0, self._amps):
+            print(self._link.command("SR,%02d,%s\r\n" % (amp, cmd)))
 
     def write_amp(self, amp, cmd, data):
-        self._laser.write("SW,%02d,%s,%s\r\n" % (amp, cmd, data))
-        while not self._laser.any():
-            utime.sleep_us(1)
-        self._laser.readline()
+        self._link.command("SW,%02d,%s,%s\r\n" % (amp, cmd, data))
         return
 
     def off(self):
@@ -121,115 +438,385 @@ class LaserCtrl:
         self.write_all(_LASER_STOP, "0")
         self.write_all(_POWER_SAVE, "0")
 
-    def start_session(self, material, thickness):
-        self._session = MeasurementSession(material, thickness)
-        self._sess_f = open(SD_FILE + "/" + self._session.get_filename(), "a+")
+    def start_session(self, material, thickness, fmt=FMT_BIN):
+        self._session = MeasurementSession(material, thickness, fmt, self.stacks)
+        mode = "a+b" if fmt == FMT_BIN else "a+"
+        self._sess_f = open(SD_FILE + "/" + self._session.get_filename(), mode)
         self._write_sess_f()
         return
 
     def _write_sess_f(self):
+        if self._session.fmt == FMT_BIN:
+            if self._sess_f.tell() == 0:
+                panel_format.write_session_header(self._sess_f,
+                                                  self._session._start_time,
+                                                  self._session._material,
+                                                  self._session._thickness,
+                                                  self.stacks)
+                self._sess_f.flush()
+            return
         self._sess_f.write("Time: ")
         ujson.dump(utime.localtime(self._session._start_time), self._sess_f)
         self._sess_f.write("\nMaterial: ")
         self._sess_f.write(self._session._material)
         self._sess_f.write("\nThickness: ")
         self._sess_f.write(self._session._thickness)
+        if self.stacks != 2:
+            self._sess_f.write("\nStacks: %d" % self.stacks)
         self._sess_f.write("\n\n")
         self._sess_f.flush()
         return
 
     def end_session(self):
+        self._session.panel.close_spill()
         self._session = None
         self._sess_f.close()
         self._sess_f = None
         return
 
-    def wait_for_panel(self, panel, lock):
-        """A blocking function to wait for panel to read"""
+    def start_worker(self):
+        """Start the acquisition thread used by measure(), once
+
+        The thread lives as long as the program and sleeps on a lock
+        between panels, so no thread is made per panel.
+        """
+        if self._job is not None:
+            return
+        self._job = _thread.allocate_lock()
+        self._job.acquire()
+        _thread.start_new_thread(self._worker, ())
+        return
+
+    def _worker(self):
+        while True:
+            self._job.acquire()
+            try:
+                self._produce(self._panel, self._job_lock, False)
+            except Exception as err:
+                # E.g. from the drain, keep the thread for the next panel
+                if self._acq_err is None:
+                    self._acq_err = err
+                print("Acquisition: {0}".format(err))
+
+    def measure(self, panel, lock, judged_cb=None):
+        """Measure a panel on the acquisition thread, returns at once
+
+        The thread holds lock while it uses the amplifiers and only puts
+        the samples in the ring. Call process() until it returns True,
+        it fills, judges and writes the panel in the caller's thread.
+        """
+        if self._panel is not None:
+            raise RuntimeError("Measurement in progress")
+        self._prepare(panel, judged_cb)
+        self._job_lock = lock
+        self._job.release()
+        return
+
+    @profiled
+    def wait_for_panel(self, panel, lock, judged_cb=None):
+        """A blocking function to wait for panel to read
+
+        judged_cb(panel) is called as soon as the verdict is known, before
+        the panel is written to the SD card. Laser timeouts and bad
+        replies end the measurement with panel.err set. The samples go
+        through the ring like with measure(), but are taken out in this
+        thread as soon as they are read.
+        """
+        self._prepare(panel, judged_cb)
+        self._produce(panel, lock, True)
+        return
+
+    def _prepare(self, panel, judged_cb):
+        self._panel = panel
+        self._judged_cb = judged_cb
+        self._acq_err = None
+        self._abort = False
+        self._started = False
+        self.ring.reset()
+        self._acq_done = False
+        return
+
+    def _produce(self, panel, lock, inline):
+        # Producer side, only the ring and the _acq_ fields are written
         lock.acquire()
+        try:
+            try:
+                self._acquire(panel, inline)
+            except Exception as err:
+                # Laser errors, and anything else so the worker thread
+                # lives on, end the panel with panel.err set
+                self._acq_err = err
+            finally:
+                # Set once, the next job may reset it as soon as it is seen
+                self._acq_done = True
+            if inline:
+                self.process()
+        finally:
+            try:
+                # The reply left in flight is drained after the verdict
+                self._stop_stream()
+            finally:
+                lock.release()
+        return
+
+    def _acquire(self, panel, inline):
         cals = self.get_phrase_pvs()
-        if cals[0] > 0 or cals[1] > 0:
-            panel.err = RuntimeError("Panel already under measure")
-            lock.release()
+        if _any_above(cals, 0):
+            self._acq_err = RuntimeError("Panel already under measure")
             return
+        if self.pipeline:
+            self._start_stream()
+            read_pvs = self._next_pvs
+        else:
+            read_pvs = self.get_phrase_pvs
+        ring = self.ring
+        start = utime.ticks_ms()
         while True:
-            cals = self.get_phrase_pvs()
-            if cals[0] < 0 or cals[1] < 0:
+            cals = read_pvs()
+            # Every stack has to see the panel
+            if _any_below(cals, 0):
+                if utime.ticks_diff(utime.ticks_ms(), start) > PANEL_WAIT_TIMEOUT:
+                    self._acq_err = RuntimeError("No panel")
+                    return
                 continue
-            else:
-                panel.start_measure(cals)
-                while True:
-                    cals = self.get_phrase_pvs()
-                    if cals[0] < 0 or cals[1] < 0:
-                        break
-                    else:
-                        try:
-                            panel.add_points(cals)
-                        except IndexError:
-                            panel.err = RuntimeError("Pushing panle to slow")
-                            lock.release()
-                            return
-                self._cal_move_mean(panel)
-                self._judgment(panel)
-                self._write_panel(panel)
+            ring.push(utime.ticks_us(), cals)
+            while not self._abort:
+                if inline:
+                    self._consume(panel)
+                t = utime.ticks_us()
+                cals = read_pvs()
+                prof_add(_PROF_READ, t)
+                if _any_below(cals, 0):
+                    break
+                if not ring.push(utime.ticks_us(), cals):
+                    self._acq_err = RuntimeError("Pushing panle to slow")
+                    return
+            return
+
+    def process(self):
+        """Consumer side of measure(), call it from the GUI
+
+        Moves the samples in the ring into the panel. Once the acquisition
+        thread is done, the panel is judged and written. Returns True when
+        the panel is finished or nothing is being measured.
+        """
+        panel = self._panel
+        if panel is None:
+            return True
+        # Read before the ring, all samples are in once it is set
+        done = self._acq_done
+        self._consume(panel)
+        if not done:
+            return False
+        self._finish(panel)
+        return True
+
+    def _consume(self, panel):
+        ring = self.ring
+        ps = self._ps
+        while not self._abort:
+            t = ring.pop_into(ps)
+            if t is None:
                 break
-        lock.release()
+            t0 = utime.ticks_us()
+            try:
+                if self._started:
+                    panel.add_points(ps, t)
+                else:
+                    panel.start_measure(ps, t)
+                    self._started = True
+            except IndexError:
+                panel.err = RuntimeError("Pushing panle to slow")
+                self._abort = True
+            except OSError as err:
+                panel.err = err
+                self._abort = True
+            prof_add(_PROF_ADD, t0)
         return
 
+    def _finish(self, panel):
+        judged_cb = self._judged_cb
+        self._panel = None
+        self._judged_cb = None
+        if panel.err is None:
+            panel.err = self._acq_err
+        if panel.err is not None:
+            return
+        try:
+            if not panel.online:
+                self._cal_move_mean(panel)
+            self._judgment(panel)
+            if judged_cb is not None:
+                judged_cb(panel)
+            self._write_panel(panel)
+        except (OSError, ValueError) as err:
+            panel.err = err
+        return
+
+    @profiled2
     def _cal_move_mean(self, panel):
+        """Sliding window mean with outlier rejection
+
+        Output i is the mean of the samples i..i+filter_size-1 that are
+        within thickness +- DATA_DIV on every stack. Running sums add the
+        incoming sample and drop the outgoing one, so the cost is O(n).
+        Sums are integer um offsets from thickness. With the ulab backend
+        it is done by _move_mean_ulab instead.
+        """
         filter_size = panel._in // 20
         panel.s_in = panel._in - filter_size
-        for i in range(0, panel.s_in):
-            sum1 = 0
-            sum2 = 0
-            n = filter_size
-            for j in range(0, filter_size):
-                if (panel._data1[i + j] > panel.thickness + DATA_DIV
-                    or panel._data1[i + j] < panel.thickness - DATA_DIV
-                    or panel._data2[i + j] > panel.thickness + DATA_DIV
-                    or panel._data2[i + j] < panel.thickness - DATA_DIV):
+        th = panel.th_um
+        hi = th + DATA_DIV_UM
+        lo = th - DATA_DIV_UM
+        stacks = panel.stacks
+        data = panel._data
+        sdata = panel._sdata
+        if filter_size == 0:
+            # Too short to filter, an empty window has no mean
+            for s in range(0, stacks):
+                b = s * MAX_PANEL_DATA
+                for i in range(b, b + panel.s_in):
+                    sdata[i] = 0
+            return
+        if _backend == BACKEND_ULAB:
+            _move_mean_ulab(panel, filter_size)
+            return
+        sums = array('i', [0] * stacks)
+        n = 0
+        for i in range(0, panel._in - 1):
+            # Drop the sample leaving the window
+            if i >= filter_size:
+                # Window i-filter_size..i-1 is complete
+                o = i - filter_size
+                _emit_mean(sdata, o, sums, n, th, stacks)
+                if _in_range(data, o, stacks, lo, hi):
+                    for s in range(0, stacks):
+                        sums[s] -= data[s * MAX_PANEL_DATA + o] - th
                     n -= 1
-                    continue
-                sum1 += panel._data1[i + j]
-                sum2 += panel._data2[i + j]
-            # TODO: There is a chance n will be zero
-            if n > 0:
-                panel._sdata1[i] = sum1 / n
-                panel._sdata2[i] = sum2 / n
-            else:
-                panel._sdata1[i] = 0
-                panel._sdata2[i] = 0
+            # Add the sample entering the window
+            if _in_range(data, i, stacks, lo, hi):
+                for s in range(0, stacks):
+                    sums[s] += data[s * MAX_PANEL_DATA + i] - th
+                n += 1
+        # Last window ends before the final sample, as it always has
+        if panel.s_in > 0:
+            _emit_mean(sdata, panel.s_in - 1, sums, n, th, stacks)
         return
 
+    @profiled2
     def _judgment(self, panel):
         panel.good = False
-        panel.diff1 = abs(max(panel._sdata1[0:panel.s_in]) - min(panel._sdata1[0:panel.s_in]))   
-        panel.diff2 = abs(max(panel._sdata2[0:panel.s_in]) - min(panel._sdata2[0:panel.s_in]))
-        if panel.diff1 < JUDGMENT_VALUE and panel.diff2 < JUDGMENT_VALUE:
-            panel.good = True
+        if panel.s_in == 0:
+            panel.err = RuntimeError("Panel too short")
+            return
+        good = True
+        for s in range(0, panel.stacks):
+            if not panel.online:
+                # Panel.add_points kept the sums while measuring otherwise
+                panel._scan_smooth(s)
+            panel._flatness(s)
+            if panel.diff[s] >= JUDGMENT_VALUE_UM:
+                good = False
+        panel.good = good
         return
 
+    @profiled2
     def _write_panel(self, panel):
-        # TODO save judgement value
+        if self._session.fmt == FMT_BIN:
+            panel_format.write_panel(self._sess_f, self._session.count, panel)
+            self._sess_f.flush()
+            return
+        # TODO save judgement value. The text format stays as the tools
+        # reading it know it, the verdict, diffs and flatness metrics
+        # are binary only, see panel_format
         print("ID: %d" % self._session.count, file = self._sess_f)
-        ujson.dump(panel._time[0:panel._in], self._sess_f)
-        self._sess_f.write("\n")
-        ujson.dump(panel._data1[0:panel._in], self._sess_f)
-        self._sess_f.write("\n")
-        ujson.dump(panel._data2[0:panel._in], self._sess_f)
-        self._sess_f.write("\n")
+        self._dump_column(panel, COL_TIME, 0, "%d")
+        for s in range(0, panel.stacks):
+            self._dump_column(panel, COL_DATA, s, "%0.3f")
         self._sess_f.flush()
         return
 
+    def _dump_column(self, panel, col, stack, fmt):
+        # A JSON list, one chunk at a time, um data is written as mm
+        scale = 1 if col == COL_TIME else UM_PER_MM
+        sep = "["
+        for chunk in panel.chunks(col, stack):
+            if len(chunk):
+                self._sess_f.write(sep)
+                self._sess_f.write(", ".join([fmt % (d / scale) for d in chunk]))
+                sep = ", "
+        self._sess_f.write("[]\n" if sep == "[" else "]\n")
+        return
+
     
+class SampleRing:
+    """Single producer, single consumer ring of timestamped samples
+
+    The acquisition thread pushes, the consumer pops, neither waits for
+    the other. Only the producer writes _head and only the consumer
+    writes _tail, and a slot is filled before _head moves past it, so no
+    lock is needed. Nothing is allocated after __init__.
+    """
+
+    def __init__(self, size=RING_SIZE, stacks=STACKS):
+        if size & (size - 1):
+            raise ValueError("Ring size must be a power of 2")
+        self._mask = size - 1
+        self._stacks = stacks
+        self._t = array('i', [0] * size)
+        # Sample i of stack s at i * stacks + s
+        self._d = array('i', [0] * (size * stacks))
+        self.reset()
+        return
+
+    def reset(self):
+        """Empty the ring, only while neither side is using it"""
+        self._head = 0
+        self._tail = 0
+        return
+
+    def available(self):
+        return self._head - self._tail
+
+    def push(self, t, ds):
+        """Producer: add a sample of every stack, False if the ring is full"""
+        h = self._head
+        if h - self._tail > self._mask:
+            return False
+        i = h & self._mask
+        self._t[i] = t
+        d = self._d
+        k = i * self._stacks
+        for s in range(0, self._stacks):
+            d[k + s] = ds[s]
+        self._head = h + 1
+        return True
+
+    def pop_into(self, ps):
+        """Consumer: take the oldest sample into ps[0:stacks], returns its
+        time or None if the ring is empty"""
+        tail = self._tail
+        if tail == self._head:
+            return None
+        i = tail & self._mask
+        d = self._d
+        k = i * self._stacks
+        for s in range(0, self._stacks):
+            ps[s] = d[k + s]
+        t = self._t[i]
+        self._tail = tail + 1
+        return t
+
+
 class MeasurementSession:
 
-    def __init__(self, material, thickness):
+    def __init__(self, material, thickness, fmt=FMT_BIN, stacks=STACKS):
         self._start_time = utime.time()
         self._material = material
         self._thickness = thickness
+        self.fmt = fmt
         self.count = 0
-        self.panel = Panel(float(thickness))
+        self.panel = Panel(float(thickness), spill_dir=SD_FILE, stacks=stacks)
         return
 
     def get_filename(self):
@@ -247,7 +834,7 @@ class MeasurementSession:
                 + self._material
                 + "_"
                 + self._thickness
-                + ".txt"
+                + panel_format.EXTENSIONS[self.fmt]
         )
         return str_
 
@@ -273,6 +860,25 @@ class MeasurementSession:
         )
         return str_
 
+    def result_json(self):
+        """The current panel's result as a JSON object for the uploader"""
+        panel = self.panel
+        return ujson.dumps({
+            "session": self.get_filename(),
+            "material": self._material,
+            "thickness": self._thickness,
+            "id": self.count,
+            "samples": panel._in,
+            "good": panel.good,
+            "diff_um": list(panel.diff),
+            "std_um": list(panel.std),
+            "flat_um": list(panel.flat),
+            "slope_um": list(panel.slope),
+            "worst": list(panel.worst),
+            "err": None if panel.err is None else str(panel.err),
+            "e_epoch": utime.time(),
+        })
+
     def new_panel(self):
         self.count += 1
         self.panel.err = None
@@ -290,34 +896,367 @@ class MeasurementSession:
 
 
 class Panel:
+    """Samples of one panel and their moving mean
+
+    The samples of all stacks are kept in one array, stack s at
+    s * MAX_PANEL_DATA, MAX_PANEL_DATA samples each, and the moving mean
+    the same way. With a spill_dir, full chunks of samples and of the
+    moving mean are appended to temporary files in that directory while
+    measuring, so a panel can be up to MAX_SPILL_DATA samples long. Use
+    chunks() to read a column back; the arrays alone only hold the last
+    chunk once spilled() is True.
+    """
 
-    def __init__(self, thickness):
+    def __init__(self, thickness, online=True, spill_dir=None, stacks=STACKS):
+        if spill_dir is not None and not online:
+            raise ValueError("Spilling needs the online filter")
         self.thickness = thickness
+        self.th_um = int(thickness * UM_PER_MM + 0.5)
+        self.stacks = stacks
         self.err = None
         self.good = False
-        self.diff1 = 0
-        self.diff2 = 0
-        self._time = array('l', [0] * MAX_PANEL_DATA)
-        self._data1 = array('f', [0.0] * MAX_PANEL_DATA)
-        self._data2 = array('f', [0.0] * MAX_PANEL_DATA)
-        self._sdata1 = array('f', [0] * MAX_PANEL_DATA)
-        self._sdata2 = array('f', [0] * MAX_PANEL_DATA)
+        # Judged max - min of each stack in um, and its flatness, see
+        # _flatness()
+        self.diff = array('i', [0] * stacks)
+        self.std = array('i', [0] * stacks)
+        self.flat = array('i', [0] * stacks)
+        self.slope = array('i', [0] * stacks)
+        self.worst = array('i', [0] * stacks)
+        self._time = array('i', [0] * MAX_PANEL_DATA)
+        # Samples in um
+        self._data = array('i', [0] * (stacks * MAX_PANEL_DATA))
+        self._sdata = array('i', [0] * (stacks * MAX_PANEL_DATA))
         self._in = 0
         self.s_in = 0
+        # Fill of the current chunk and full chunks already spilled
+        self._c = 0
+        self._sc = 0
+        self._raw_chunks = 0
+        self._s_chunks = 0
+        self._spill_dir = spill_dir
+        self._raw_f = None
+        self._s_f = None
+        self._scratch = None
+        # Online moving mean, filled by add_points while measuring. Slot
+        # k of stack s of the window at k * stacks + s
+        self.online = online
+        self._win = array('i', [0] * (FILTER_SIZE * stacks))
+        self._win_ok = bytearray(FILTER_SIZE)
+        self._sum = array('i', [0] * stacks)
+        self._smax = array('i', [0] * stacks)
+        self._smin = array('i', [0] * stacks)
+        # Sums of the moving mean for _flatness(), kept by _filter_step or
+        # _scan_smooth. Lists, they outgrow 32 bits on long panels
+        self._sy = [0] * stacks
+        self._syy = [0] * stacks
+        self._sxy = [0] * stacks
+        self._imax = array('i', [0] * stacks)
+        self._imin = array('i', [0] * stacks)
+        self._reset_filter()
         return
 
-    def start_measure(self, points):
-        self._t_start = utime.ticks_us()
+    @property
+    def diff1(self):
+        return self.diff[0]
+
+    @property
+    def diff2(self):
+        return self.diff[1] if self.stacks > 1 else 0
+
+    def _reset_filter(self):
+        for s in range(0, self.stacks):
+            self._sum[s] = 0
+            self._smax[s] = 0
+            self._smin[s] = 0
+            self._sy[s] = 0
+            self._syy[s] = 0
+            self._sxy[s] = 0
+        self._n = 0
+        return
+
+    def start_measure(self, points, t=None):
+        """Start a panel with its first sample, t is its ticks_us()"""
+        self._t_start = utime.ticks_us() if t is None else t
         self._in = 0
-        self.add_points(points)
+        self.s_in = 0
+        self._c = 0
+        self._sc = 0
+        self._raw_chunks = 0
+        self._s_chunks = 0
+        self._reset_filter()
+        self.add_points(points, t)
         return
 
-    def add_points(self, ps):
-        try:
-            self._time[self._in] = utime.ticks_diff(utime.ticks_us(), self._t_start)
-            self._data1[self._in] = ps[0]
-            self._data2[self._in] = ps[1]
-        except IndexError:
-            raise
+    def add_points(self, ps, t=None):
+        """Add a sample, ps[s] is the thickness of stack s in um
+
+        Raises IndexError once the panel holds MAX_SPILL_DATA samples, or
+        MAX_PANEL_DATA without a spill_dir.
+        """
+        if self._in >= MAX_SPILL_DATA:
+            # The record count is 16 bit
+            raise IndexError("Panel buffer full")
+        c = self._c
+        if c == MAX_PANEL_DATA:
+            if self._spill_dir is None:
+                raise IndexError("Panel buffer full")
+            self._spill_raw()
+            c = 0
+        if t is None:
+            t = utime.ticks_us()
+        self._time[c] = utime.ticks_diff(t, self._t_start)
+        data = self._data
+        for s in range(0, self.stacks):
+            data[s * MAX_PANEL_DATA + c] = ps[s]
+        self._c = c + 1
+        if self.online:
+            self._filter_step(self._in, ps)
         self._in += 1
         return
+
+    def filter_size(self):
+        """Moving mean window of the panel's own filter
+
+        FILTER_SIZE for the online filter, _in // 20 for _cal_move_mean.
+        """
+        if self.online:
+            return FILTER_SIZE
+        return self._in // 20
+
+    def spilled(self):
+        return self._raw_chunks > 0 or self._s_chunks > 0
+
+    def _spill_raw(self):
+        # A chunk is the times, then the samples of every stack
+        if self._raw_f is None:
+            self._raw_f = open(self._spill_dir + "/.panel_raw.tmp", "w+b")
+        self._raw_f.seek(self._raw_chunks * (1 + self.stacks) * MAX_PANEL_DATA * 4)
+        self._raw_f.write(self._time)
+        self._raw_f.write(self._data)
+        self._raw_chunks += 1
+        self._c = 0
+        return
+
+    def _spill_smooth(self):
+        if self._s_f is None:
+            self._s_f = open(self._spill_dir + "/.panel_smooth.tmp", "w+b")
+        self._s_f.seek(self._s_chunks * self.stacks * MAX_PANEL_DATA * 4)
+        self._s_f.write(self._sdata)
+        self._s_chunks += 1
+        self._sc = 0
+        return
+
+    def chunks(self, col, stack=0):
+        """Yield one column of the panel chunk by chunk
+
+        col is COL_TIME, or COL_DATA or COL_SDATA of stack. Spilled
+        chunks are read back into one scratch array, so each view is only
+        valid until the next one is yielded.
+        """
+        if col == COL_TIME:
+            f = self._raw_f
+            full = self._raw_chunks
+            pos = 0
+            step = 1 + self.stacks
+            last = memoryview(self._time)
+            n = self._c
+        elif col == COL_DATA:
+            f = self._raw_f
+            full = self._raw_chunks
+            pos = 1 + stack
+            step = 1 + self.stacks
+            last = memoryview(self._data)[stack * MAX_PANEL_DATA:]
+            n = self._c
+        else:
+            f = self._s_f
+            full = self._s_chunks
+            pos = stack
+            step = self.stacks
+            last = memoryview(self._sdata)[stack * MAX_PANEL_DATA:]
+            n = self._sc
+        if full and self._scratch is None:
+            self._scratch = array('i', [0] * MAX_PANEL_DATA)
+        for k in range(0, full):
+            f.seek((k * step + pos) * MAX_PANEL_DATA * 4)
+            f.readinto(self._scratch)
+            yield memoryview(self._scratch)
+        yield last[0:n]
+
+    def close_spill(self):
+        for f in (self._raw_f, self._s_f):
+            if f is not None:
+                f.close()
+        self._raw_f = None
+        self._s_f = None
+        self._raw_chunks = 0
+        self._s_chunks = 0
+        return
+
+    def sample_stats(self):
+        """Acquisition rate of the last panel
+
+        Returns (samples/s, mean interval us, interval std dev us, max
+        interval us) from the sample times.
+        """
+        n = self._in
+        if n < 2:
+            return (0.0, 0.0, 0.0, 0)
+        first = None
+        prev = 0
+        for t in self.chunks(COL_TIME):
+            for ti in t:
+                if first is None:
+                    first = ti
+                prev = ti
+        mean = (prev - first) / (n - 1)
+        var = 0.0
+        worst = 0
+        prev = first
+        for t in self.chunks(COL_TIME):
+            for ti in t:
+                dt = ti - prev
+                var += (dt - mean) * (dt - mean)
+                if dt > worst:
+                    worst = dt
+                prev = ti
+        return (1000000 / mean if mean > 0 else 0.0, mean,
+                (var / (n - 1)) ** 0.5, worst)
+
+    def _scan_smooth(self, s):
+        """Flatness sums of stack s from its moving mean, in one pass
+
+        What _filter_step keeps while measuring, for a panel filtered by
+        LaserCtrl._cal_move_mean. Those never spill, the series is read in
+        place.
+        """
+        th = self.th_um
+        b = s * MAX_PANEL_DATA
+        sdata = memoryview(self._sdata)[b:b + self.s_in]
+        sy = 0
+        syy = 0
+        sxy = 0
+        vmax = vmin = sdata[0]
+        imax = imin = 0
+        x = 0
+        for v in sdata:
+            d = v - th
+            sy += d
+            syy += d * d
+            sxy += x * d
+            if v > vmax:
+                vmax = v
+                imax = x
+            elif v < vmin:
+                vmin = v
+                imin = x
+            x += 1
+        self._sy[s] = sy
+        self._syy[s] = syy
+        self._sxy[s] = sxy
+        self._smax[s] = vmax
+        self._smin[s] = vmin
+        self._imax[s] = imax
+        self._imin[s] = imin
+        return
+
+    def _flatness(self, s):
+        """Judgment values of stack s from the sums of its moving mean
+
+        diff is max - min, std the standard deviation, flat the standard
+        deviation about the least-squares line, slope the rise of that
+        line from the first to the last sample and worst the index of the
+        sample furthest from the mean, all in um. The sums are exact
+        integers over the offsets d from thickness at index x, only the
+        results are float.
+        """
+        n = self.s_in
+        sy = self._sy[s]
+        smax = self._smax[s]
+        smin = self._smin[s]
+        self.diff[s] = smax - smin
+        # n times the sums of squares and products about the means
+        a = n * self._syy[s] - sy * sy
+        b = n * self._sxy[s] - (n * (n - 1) // 2) * sy
+        c = n * n * (n * n - 1) // 12
+        self.std[s] = int(a ** 0.5 / n + 0.5)
+        if c > 0:
+            self.slope[s] = round(b * (n - 1) / c)
+            # a * c >= b * b, exactly
+            self.flat[s] = int(((a * c - b * b) / c) ** 0.5 / n + 0.5)
+        else:
+            self.slope[s] = 0
+            self.flat[s] = 0
+        th = self.th_um
+        if n * (smax - th) - sy >= sy - n * (smin - th):
+            self.worst[s] = self._imax[s]
+        else:
+            self.worst[s] = self._imin[s]
+        return
+
+    def _filter_step(self, i, ps):
+        """Advance the moving mean by sample i, ps[s] of stack s in um
+
+        Same window and outlier rejection as LaserCtrl._cal_move_mean with
+        a fixed FILTER_SIZE. The window before sample i is emitted first,
+        so s_in is final as soon as the trailing edge is seen. The window
+        keeps its own copy of the samples, they may have been spilled.
+        """
+        th = self.th_um
+        stacks = self.stacks
+        sums = self._sum
+        win = self._win
+        slot = i % FILTER_SIZE
+        w = slot * stacks
+        if i >= FILTER_SIZE:
+            # Window i-FILTER_SIZE..i-1 is complete
+            if self._sc == MAX_PANEL_DATA:
+                self._spill_smooth()
+            n = self._n
+            sc = self._sc
+            x = self.s_in
+            smax = self._smax
+            smin = self._smin
+            sy = self._sy
+            syy = self._syy
+            sxy = self._sxy
+            for s in range(0, stacks):
+                v = th + _div_round(sums[s], n) if n > 0 else 0
+                self._sdata[s * MAX_PANEL_DATA + sc] = v
+                # Flatness sums, as _scan_smooth
+                d = v - th
+                sy[s] += d
+                syy[s] += d * d
+                sxy[s] += x * d
+                if x == 0:
+                    smax[s] = v
+                    smin[s] = v
+                    self._imax[s] = 0
+                    self._imin[s] = 0
+                elif v > smax[s]:
+                    smax[s] = v
+                    self._imax[s] = x
+                elif v < smin[s]:
+                    smin[s] = v
+                    self._imin[s] = x
+            self._sc = sc + 1
+            self.s_in += 1
+            # Drop the sample leaving the window, it shares the slot
+            if self._win_ok[slot]:
+                for s in range(0, stacks):
+                    sums[s] -= win[w + s]
+                self._n -= 1
+        lo = th - DATA_DIV_UM
+        hi = th + DATA_DIV_UM
+        ok = 1
+        for s in range(0, stacks):
+            if ps[s] < lo or ps[s] > hi:
+                ok = 0
+                break
+        if ok:
+            for s in range(0, stacks):
+                d = ps[s] - th
+                win[w + s] = d
+                sums[s] += d
+            self._n += 1
+        self._win_ok[slot] = ok
+        return
@@ -10,24 +10,50 @@ import _thread
 import utime
 import uos
 import ujson
-import usocket
-import uselect
 
 import ntptime
 import machine
 from micropython import const
 
 import si7021
-from utils import timed_function
+from uploader import Uploader
+from utils import timed_function, profiled1, boot_mark, SensorCache
 
 _ssid = 'Westhill_2.4G'
 _wp2_pass = 'Radoslav13'
 TIME_ZONE_OFFSET = const(14400)
 WIFI_CON_TIMEOUT = const(30000)
+# Wait before the next attempt after a failed one, doubled every time
+WIFI_BACKOFF_MIN = const(2000)
+WIFI_BACKOFF_MAX = const(300000)
+# Retry of a failed NTP sync while the link is up
+WIFI_SYNC_RETRY = const(60000)
+# WifiManager states
+WIFI_DOWN = const(0)
+WIFI_CONNECTING = const(1)
+WIFI_UP = const(2)
 SERVER_ADDR = "192.168.0.22"
-SELECT_TIMEOUT = 100
+SERVER_PORT = const(8000)
+# Records not uploaded yet, on the SD card
+UPLOAD_QUEUE_FILE = "/upload.q"
 TIME_FILE = "/time"
 SD_FILE = "/sd"
+# Check the SI7021 checksum, a bad reading raises RuntimeError
+TH_CHECK_CRC = True
+# Oldest TH reading save_th_data takes from the cache, the header task
+# refreshes it every second
+TH_MAX_AGE = const(5000)
+# TH log rows are written in blocks of TH_LOG_ROWS, or once the oldest
+# buffered row is TH_LOG_PERIOD ms old
+TH_LOG_ROWS = const(15)
+TH_LOG_PERIOD = const(900000)
+# "YYYY-MM-DD-HH-MM\t<temp>\t\t<rh>\n" takes at most 36 bytes
+_TH_ROW_SIZE = const(40)
+TH_LOG_HEADER = b"YYYY-MM-DD-HH-MM(RTC)\tTemperature(C)\tHumidity(RH%)\n"
+# Profile summary appended at the end of a session, on the SD card
+PROF_FILE = "/prof.txt"
+# Boot timeline appended after every boot, on the SD card
+BOOT_FILE = "/boot.txt"
 
 
 class LaserMCU:
@@ -35,31 +61,54 @@ class LaserMCU:
     def __init__(self):
         self._name = "Westhill Laser Measument System"
         self._wlan = network.WLAN(network.STA_IF)
-        self.connect_wifi()
-        self._sd = machine.SDCard(slot=3, sck=machine.Pin(14), miso=machine.Pin(12)
-                                 ,mosi=machine.Pin(13),cs=machine.Pin(15))
-        uos.mount(self._sd, SD_FILE)
-        self._th_sensor = si7021.SI7021(4, 21)
+        # Connects in the background, poll_wifi() drives it
+        self.wifi = WifiManager(self._wlan, _ssid, _wp2_pass, self.set_time_ntp)
+        # Not needed for the first screen, up on first use or late_init()
+        self._sd = None
+        self._th_sensor = None
+        # (temperature, humidity) shared by the header and the TH log
+        self.th_cache = SensorCache("th_cache", self._read_th, TH_MAX_AGE)
+        self._th_log = THLog(SD_FILE)
+        self.uploader = Uploader(SERVER_ADDR, SERVER_PORT,
+                                 SD_FILE + UPLOAD_QUEUE_FILE, self.is_connected)
         self._buzz = Buzzer(26)
         
-    def connect_wifi(self):
-        if not self.is_connected():
-            self._wlan.active(True)
-            self._wlan.connect(_ssid, _wp2_pass)
-            start = utime.ticks_ms()
-            print("Connecting Wifi: [", end = '')
-            while True:
-                utime.sleep_ms(WIFI_CON_TIMEOUT // 40)
-                print("-", end="")
-                if utime.ticks_diff(utime.ticks_ms(), start) >= WIFI_CON_TIMEOUT:
-                    print("]")
-                    print("Fail to connect WIFI")
-                    break
-                elif self.is_connected():
-                    print("]")
-                    break
+    def late_init(self):
+        """Bring up the SD card, TH sensor and WiFi, after the first frame
+
+        Each step is marked in the boot timeline; a failing one is
+        reported and left to its first use.
+        """
+        for name, init in (("sd", self.mount_sd), ("th_sensor", self.th_sensor),
+                           ("wifi_start", self.poll_wifi)):
+            try:
+                init()
+            except Exception as err:
+                # E.g. RuntimeError from the SI7021 USER1 check, the
+                # other steps and boot_dump() still run
+                print("{0}: {1}: {2}".format(name, type(err).__name__, err))
+            boot_mark(name)
+        return
+
+    def mount_sd(self):
+        """Mount the SD card at SD_FILE unless it is already"""
+        if self._sd is None:
+            sd = machine.SDCard(slot=3, sck=machine.Pin(14), miso=machine.Pin(12)
+                                ,mosi=machine.Pin(13),cs=machine.Pin(15))
+            uos.mount(sd, SD_FILE)
+            self._sd = sd
         return
 
+    def th_sensor(self):
+        """The SI7021, reset on first use"""
+        if self._th_sensor is None:
+            self._th_sensor = si7021.SI7021(4, 21)
+        return self._th_sensor
+
+    def poll_wifi(self):
+        """Step the WiFi connection, returns its WIFI_* state"""
+        return self.wifi.poll()
+
     def alt(self):
         self._buzz.alt()
         return
@@ -68,70 +117,66 @@ class LaserMCU:
         self._buzz.warn()
         return
 
+    @profiled1
     def save_th_data(self):
         # Time in utc
         et = utime.time()
         dt = utime.localtime()
-        temp = self._th_sensor.read_temperature()
-        rh = self._th_sensor.read_relative_humidity()
-        filename = (
-            ("TH-%04d" % dt[0])
-            + "_"
-            + ("%02d" % dt[1])
-            + "_"
-            + ("%02d" % dt[2])
-            + ".txt"
-        )
+        temp, rh = self.th_cache.get()
+        self.mount_sd()
+        self.uploader.add("/th/", '{"temp":%0.3f,"rh":%0.3f,"e_epoch":%d}' % (temp, rh, et))
+        self._th_log.add(dt, temp, rh)
+        return
+
+    def flush_th(self):
+        """Write the buffered TH rows to the SD card"""
+        self.mount_sd()
+        self._th_log.flush()
+        return
+
+    def shutdown(self):
+        """Flush and close the TH log and the uploader before power off or reset
+
+        Records the uploader can not send now are kept in its queue file.
+        Called from the Done tab and main.restart(), both reopen on use.
+        """
         try:
-            f = open(SD_FILE + "/" + filename, "a+")
-        except OSError as err:
-            raise
-        if f.tell() == 0:
-            print("YYYY-MM-DD-HH-MM(RTC)\tTemperature(C)\tHumidity(RH%)", file = f)
-            
-        print("%04d-%02d-%02d-%02d-%02d\t%0.3f\t\t%0.3f" % (dt[0], dt[1], dt[2], dt[3], dt[4], temp, rh), file = f)
-        f.close()
-        
-        #content = ('{"temp":%0.3f,"rh":%0.3f,"e_epoch":%d}' % (temp, rh, et))
-        ##try:
-            ##self._post_json("/th/", content)
-        ##except OSError as err:
-            ##print(OSError, err)
+            self.mount_sd()
+            self._th_log.close()
+        finally:
+            self.uploader.flush()
+            self.uploader.close()
         return
-    
-    def _post_json(self, path, content):
-        s = usocket.socket()
-        s.connect((SERVER_ADDR, 8000))
-        p = uselect.poll()
-        p.register(s)
-        for so in p.poll(SELECT_TIMEOUT):
-            if so[1] | uselect.POLLOUT:
-                size = len(content)
-                so[0].send(
-                    bytes(
-                        (
-                            "POST %s HTTP/1.1\r\n"
-                            "Host: %s\r\n"
-                            "Content-Type: application/json\r\n"
-                            "Content-Length: %d\r\n\r\n"
-                        )
-                        % (path, SERVER_ADDR, size),
-                        "utf8"
-                    )
-                )
-                so[0].send(bytes(content, "utf8"))
-        for so in p.poll(SELECT_TIMEOUT):
-            if (so[1] | uselect.POLLIN):
-                ret = so[0].readline()
-                if ret.split()[1][0] != 50:
-                    so[0].close()
-                    raise OSError(ret.decode("utf8"))
-        s.close()
-        return
-            
+
+    @profiled1
+    def poll_th(self):
+        """Non-blocking TH reading for the GUI tasks
+
+        Collects the conversion started by the last call and starts the
+        next one, so each call costs a couple of short I2C transfers.
+        Returns True if a new reading came in.
+        """
+        sensor = self.th_sensor()
+        state = sensor.poll(TH_CHECK_CRC)
+        if state == si7021.CONVERTING:
+            return False
+        if state == si7021.ERROR:
+            print("TH sensor: {0}".format(sensor.error))
+        elif state == si7021.READY:
+            self.th_cache.put((sensor.temperature, sensor.relative_humidity))
+        sensor.start()
+        return state == si7021.READY
+
+    def _read_th(self):
+        return self.th_sensor().read_both(TH_CHECK_CRC)
+
+    @profiled1
     def get_th_str(self):
-        th_str = "T: " + str("%0.2f" % self._th_sensor.read_temperature()) + " H: " \
-            + str("%0.2f" % self._th_sensor.read_relative_humidity())
+        """The last reading of poll_th, "--" once it is older than TH_MAX_AGE"""
+        if not self.th_cache.fresh():
+            return "T: -- H: --"
+        temp, rh = self.th_cache.value
+        th_str = "T: " + str("%0.2f" % temp) + " H: " + str("%0.2f" % rh)
         return th_str
     
     def set_time_ntp(self):
@@ -191,6 +236,216 @@ class LaserMCU:
     def __str__(self):
         return self._name
 
+def _put_dec(buf, i, v, width):
+    """v zero padded to width digits at buf[i], returns the end"""
+    for k in range(i + width - 1, i - 1, -1):
+        buf[k] = 48 + v % 10
+        v //= 10
+    return i + width
+
+
+def _put_milli(buf, i, v):
+    """v like "%0.3f" at buf[i], returns the end"""
+    m = int(v * 1000 + (0.5 if v >= 0 else -0.5))
+    if m < 0:
+        buf[i] = 45
+        i += 1
+        m = -m
+    q = m // 1000
+    width = 1
+    p = 10
+    while q >= p:
+        width += 1
+        p *= 10
+    i = _put_dec(buf, i, q, width)
+    buf[i] = 46
+    return _put_dec(buf, i + 1, m % 1000, 3)
+
+
+class THLog:
+    """Daily temperature and humidity log, TH-YYYY_MM_DD.txt
+
+    Rows are formatted in place into a preallocated buffer and appended
+    in one write once TH_LOG_ROWS are buffered or the oldest is
+    TH_LOG_PERIOD ms old, when the date changes and on close(). The day's
+    file stays open between writes and its name is only made once a day.
+    """
+
+    def __init__(self, directory):
+        self._dir = directory
+        self._buf = bytearray(_TH_ROW_SIZE * TH_LOG_ROWS)
+        self._n = 0
+        self._rows = 0
+        self._t_first = 0
+        # Date of the buffered rows and the open file as YYYYMMDD
+        self._day = 0
+        self._filename = None
+        self._f = None
+        self.flushes = 0
+        return
+
+    def add(self, dt, temp, rh):
+        """Buffer a row for the localtime() tuple dt
+
+        Raises OSError if a flush fails, the buffered rows are kept and
+        written with the next flush, a row that does not fit is lost.
+        """
+        day = dt[0] * 10000 + dt[1] * 100 + dt[2]
+        if day != self._day:
+            self.close()
+            self._day = day
+            self._filename = self._dir + "/" + ("TH-%04d_%02d_%02d.txt" % (dt[0], dt[1], dt[2]))
+        if self._rows == TH_LOG_ROWS:
+            # The last flush failed
+            self.flush()
+        if not self._rows:
+            self._t_first = utime.ticks_ms()
+        buf = self._buf
+        i = _put_dec(buf, self._n, dt[0], 4)
+        for k in range(1, 5):
+            buf[i] = 45
+            i = _put_dec(buf, i + 1, dt[k], 2)
+        buf[i] = 9
+        i = _put_milli(buf, i + 1, temp)
+        buf[i] = 9
+        buf[i + 1] = 9
+        i = _put_milli(buf, i + 2, rh)
+        buf[i] = 10
+        self._n = i + 1
+        self._rows += 1
+        if (self._rows == TH_LOG_ROWS
+            or utime.ticks_diff(utime.ticks_ms(), self._t_first) >= TH_LOG_PERIOD):
+            self.flush()
+        return
+
+    def flush(self):
+        """Append the buffered rows to the day's file in one write"""
+        if not self._rows:
+            return
+        try:
+            if self._f is None:
+                self._f = open(self._filename, "ab+")
+                if self._f.tell() == 0:
+                    self._f.write(TH_LOG_HEADER)
+            self._f.write(memoryview(self._buf)[0:self._n])
+            self._f.flush()
+        except OSError:
+            # Reopen next time, the card may have been swapped
+            self._close_file()
+            raise
+        self._n = 0
+        self._rows = 0
+        self.flushes += 1
+        return
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._close_file()
+        return
+
+    def _close_file(self):
+        if self._f is not None:
+            try:
+                self._f.close()
+            except OSError:
+                pass
+            self._f = None
+        return
+
+
+class WifiManager:
+    """WiFi station connection kept up in the background
+
+    poll() never waits, call it periodically (e.g. from an lvgl task).
+    It starts a connection, gives it up after WIFI_CON_TIMEOUT ms and
+    tries again after a backoff doubling from WIFI_BACKOFF_MIN to
+    WIFI_BACKOFF_MAX ms, and reconnects when the link drops. sync is
+    called once the link is up, e.g. for NTP, and again every
+    WIFI_SYNC_RETRY ms until it returns without OSError.
+    """
+
+    def __init__(self, wlan, ssid, password, sync=None):
+        self._wlan = wlan
+        self._ssid = ssid
+        self._password = password
+        self._sync = sync
+        self.state = WIFI_DOWN
+        self._t = utime.ticks_ms()
+        # Wait from _t before the next attempt
+        self._wait = 0
+        self._backoff = WIFI_BACKOFF_MIN
+        self._synced = False
+        self._t_sync = 0
+        self.attempts = 0
+        self.ups = 0
+        return
+
+    def poll(self):
+        now = utime.ticks_ms()
+        if self.state == WIFI_UP:
+            if not self._wlan.isconnected():
+                print("Wifi lost")
+                self.state = WIFI_DOWN
+                self._t = now
+                self._wait = 0
+                self._backoff = WIFI_BACKOFF_MIN
+            elif (not self._synced
+                  and utime.ticks_diff(now, self._t_sync) >= WIFI_SYNC_RETRY):
+                self._try_sync(now)
+        elif self.state == WIFI_CONNECTING:
+            if self._wlan.isconnected():
+                print("Wifi connected")
+                self.state = WIFI_UP
+                self.ups += 1
+                self._backoff = WIFI_BACKOFF_MIN
+                self._synced = False
+                self._try_sync(now)
+            elif utime.ticks_diff(now, self._t) >= WIFI_CON_TIMEOUT:
+                print("Fail to connect WIFI")
+                self._retry_later(now)
+        elif utime.ticks_diff(now, self._t) >= self._wait:
+            self.attempts += 1
+            try:
+                self._wlan.active(True)
+                self._wlan.connect(self._ssid, self._password)
+            except OSError as err:
+                print("Wifi: {0}".format(err))
+                self._retry_later(now)
+            else:
+                self.state = WIFI_CONNECTING
+                self._t = now
+        return self.state
+
+    def is_up(self):
+        return self.state == WIFI_UP
+
+    def _retry_later(self, now):
+        try:
+            self._wlan.disconnect()
+        except OSError:
+            pass
+        self.state = WIFI_DOWN
+        self._t = now
+        self._wait = self._backoff
+        self._backoff = min(self._backoff * 2, WIFI_BACKOFF_MAX)
+        return
+
+    def _try_sync(self, now):
+        self._t_sync = now
+        if self._sync is None:
+            self._synced = True
+            return
+        try:
+            self._sync()
+        except OSError as err:
+            print("OSError: {0}".format(err))
+            return
+        self._synced = True
+        return
+
+
 class Buzzer:
 
     def __init__(self, pin):
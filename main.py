@@ -8,10 +8,21 @@ Main program for the laser measument system
 import esp
 from machine import reset
 
+import utils
+utils.boot_mark("firmware")
 import gui_ctrl
+utils.boot_mark("imports")
 
 
 # Only log errors
 esp.osdebug(0, esp.LOG_ERROR)
 # The LaserGui object controlles all the async update
 laser_gui = gui_ctrl.LaserGui()
+
+
+def restart():
+    """Flush the TH log and the upload queue to the SD card, then reset"""
+    try:
+        laser_gui.mcu.shutdown()
+    finally:
+        reset()
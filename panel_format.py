@@ -0,0 +1,329 @@
+"""panel_format.py
+
+Session file formats written by LaserCtrl and a reader for both of them.
+Runs on MicroPython and CPython, so session files can be read back on the
+MCU or on a PC after pulling the SD card.
+
+Text format (FMT_TEXT, *.txt), the original one::
+
+    Time: [2019, 8, 9, 10, 30, 0, 4, 221]
+    Material: WPC
+    Thickness: 12
+    Stacks: 3               only if not 2
+
+    ID: 1
+    array('l', [time_us, ...])
+    [data1_mm, ...]         one line per stack
+    [data2_mm, ...]
+
+ujson prints arrays with their repr, older files have array('f', [...])
+data lines. Both are accepted. The text format is kept as it is for the
+tools that read it, so it has no judgment: the verdict, the diffs and
+the flatness metrics are only stored in the binary format.
+
+Binary format (FMT_BIN, *.bin), version 3. All values little-endian::
+
+    session header  SESS_HDR
+        magic       4s   b"LMSB"
+        version     B    VERSION
+        stacks      B    number of thickness stacks
+        hdr_size    H    bytes in this header, readers skip to it
+        start_time  i    utime.time() when the session started
+        material    16s  NUL padded ASCII
+        thickness   8s   NUL padded ASCII, as chosen in the GUI
+    panel record, repeated
+        PANEL_HDR
+            tag     4s   b"PANL"
+            id      I    panel number in the session, 1 based
+            count   H    n, samples in the panel
+            flags   B    FLAG_GOOD | FLAG_ERR
+            reserved B   0
+            diff1   i    judged max - min of stack 1 (um)
+            diff2   i    judged max - min of stack 2 (um), 0 if 1 stack
+            thickness i  nominal thickness (um)
+        diffs       int32[stacks - 2]  stacks 3.., only with more than 2
+        METRICS     per stack, flatness of the moving mean (um)
+            std     i    standard deviation
+            flat    i    standard deviation about the least-squares line
+            slope   i    rise of the least-squares line over the panel
+            worst   I    index of the moving mean sample furthest from
+                         the mean
+        time        int32[n]  us since the first sample
+        data        int32[n]  thickness (um), one array per stack
+
+Version 2 has no METRICS. Version 1 is version 2 with float32 mm in
+place of the int32 um fields. A reader for a new version should keep
+handling the older ones, the version is checked per file by
+SessionReader. PanelRecord.unit tells if the data arrays are "mm" or
+"um", diffs, thickness and the metrics are always mm.
+"""
+from array import array
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+FMT_TEXT = 0
+FMT_BIN = 1
+EXTENSIONS = (".txt", ".bin")
+
+MAGIC = b"LMSB"
+VERSION = 3
+SESS_HDR = "<4sBBHi16s8s"
+SESS_HDR_SIZE = struct.calcsize(SESS_HDR)
+PANEL_TAG = b"PANL"
+PANEL_HDR = "<4sIHBBiii"
+PANEL_HDR_V1 = "<4sIHBBfff"
+PANEL_HDR_SIZE = struct.calcsize(PANEL_HDR)
+METRICS = "<iiiI"
+METRICS_SIZE = struct.calcsize(METRICS)
+FLAG_GOOD = 0x01
+FLAG_ERR = 0x02
+
+_panel_hdr_buf = bytearray(PANEL_HDR_SIZE)
+_diff_buf = bytearray(4)
+_metrics_buf = bytearray(METRICS_SIZE)
+
+
+def write_session_header(f, start_time, material, thickness, stacks=2):
+    f.write(struct.pack(SESS_HDR, MAGIC, VERSION, stacks, SESS_HDR_SIZE,
+                        start_time, material.encode(), thickness.encode()))
+    return
+
+
+def panel_hdr_size(stacks, version=VERSION):
+    """Bytes of a panel record header, with the diffs of stacks 3.. and
+    the metrics"""
+    size = PANEL_HDR_SIZE + 4 * max(0, stacks - 2)
+    if version >= 3:
+        size += METRICS_SIZE * stacks
+    return size
+
+
+def record_size(stacks, n, version=VERSION):
+    """Bytes of a panel record of n samples"""
+    return panel_hdr_size(stacks, version) + 4 * n * (1 + stacks)
+
+
+def write_panel(f, pid, panel):
+    """Write one panel record straight from the panel arrays
+
+    The samples go out through memoryviews of the arrays, stack after
+    stack and chunk by chunk for a panel that spilled to SD, nothing is
+    converted or copied.
+    """
+    n = panel._in
+    flags = 0
+    if panel.good:
+        flags |= FLAG_GOOD
+    if panel.err is not None:
+        flags |= FLAG_ERR
+    struct.pack_into(PANEL_HDR, _panel_hdr_buf, 0, PANEL_TAG, pid, n, flags, 0,
+                     panel.diff1, panel.diff2, panel.th_um)
+    f.write(_panel_hdr_buf)
+    for s in range(2, panel.stacks):
+        struct.pack_into("<i", _diff_buf, 0, panel.diff[s])
+        f.write(_diff_buf)
+    for s in range(0, panel.stacks):
+        struct.pack_into(METRICS, _metrics_buf, 0, panel.std[s], panel.flat[s],
+                         panel.slope[s], panel.worst[s])
+        f.write(_metrics_buf)
+    # Panel.chunks() columns COL_TIME and COL_DATA
+    for chunk in panel.chunks(0):
+        f.write(chunk)
+    for s in range(0, panel.stacks):
+        for chunk in panel.chunks(1, s):
+            f.write(chunk)
+    return
+
+
+def panel_hdr(version):
+    """Panel header struct format of a file version"""
+    return PANEL_HDR_V1 if version < 2 else PANEL_HDR
+
+
+def data_typecode(version):
+    """array typecode of the data samples of a file version"""
+    return 'f' if version < 2 else 'i'
+
+
+def unpack_panel_hdr(version, buf, offset=0, stacks=2):
+    """(id, count, good, err, [diff mm per stack], thickness mm, metrics)
+    of a record
+
+    buf holds panel_hdr_size(stacks, version) bytes of the record at
+    offset. metrics is a (std, flat, slope, worst) tuple per stack, in mm
+    but for the worst index, or None before version 3.
+    """
+    tag, pid, n, flags, _, diff1, diff2, th = struct.unpack_from(panel_hdr(version),
+                                                                 buf, offset)
+    if tag != PANEL_TAG:
+        raise ValueError("Bad panel record")
+    diffs = [diff1, diff2][0:stacks]
+    for s in range(2, stacks):
+        diffs.append(struct.unpack_from("<i", buf, offset + PANEL_HDR_SIZE + 4 * (s - 2))[0])
+    if version >= 2:
+        diffs = [d / 1000 for d in diffs]
+        th /= 1000
+    metrics = None
+    if version >= 3:
+        metrics = []
+        off = offset + panel_hdr_size(stacks, 2)
+        for s in range(0, stacks):
+            std, flat, slope, worst = struct.unpack_from(METRICS, buf,
+                                                         off + METRICS_SIZE * s)
+            metrics.append((std / 1000, flat / 1000, slope / 1000, worst))
+    return pid, n, bool(flags & FLAG_GOOD), bool(flags & FLAG_ERR), diffs, th, metrics
+
+
+def text_list(line):
+    line = line.strip()
+    if line.startswith(b"array("):
+        # array('f', [...]) as printed by ujson
+        line = line[line.index(b"["):-1]
+    return json.loads(line)
+
+
+class PanelRecord:
+    """One panel read back from a session file
+
+    diffs and data hold one entry per stack, diff1, data1 etc. are those
+    of the first two stacks. good, the diffs and metrics are None for
+    text files, which do not store the judgment. metrics is a (std, flat,
+    slope, worst) tuple per stack, see METRICS, None before version 3. unit
+    is the unit of the data, "mm" or "um".
+    """
+
+    def __init__(self, pid, count, good, err, diffs, thickness, time, data,
+                 unit="mm", metrics=None):
+        self.id = pid
+        self.count = count
+        self.good = good
+        self.err = err
+        self.diffs = diffs
+        self.thickness = thickness
+        self.time = time
+        self.data = data
+        self.unit = unit
+        self.metrics = metrics
+        return
+
+    @property
+    def stacks(self):
+        return len(self.data)
+
+    @property
+    def diff1(self):
+        return None if self.diffs is None else self.diffs[0]
+
+    @property
+    def diff2(self):
+        return None if self.diffs is None or len(self.diffs) < 2 else self.diffs[1]
+
+    @property
+    def data1(self):
+        return self.data[0]
+
+    @property
+    def data2(self):
+        return self.data[1] if len(self.data) > 1 else None
+
+
+class SessionReader:
+    """Read a session file of either format
+
+        with open(path, "rb") as f:
+            sess = SessionReader(f)
+            for p in sess:
+                print(p.id, p.count, p.diff1, p.diff2)
+
+    The format is detected from the first bytes of the file. start_time
+    is utime.time() for binary files and the utime.localtime() list for
+    text files.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        magic = f.read(4)
+        if magic == MAGIC:
+            self.fmt = FMT_BIN
+            self._read_bin_header(magic)
+        elif magic == b"Time":
+            self.fmt = FMT_TEXT
+            self._read_text_header(magic)
+        else:
+            raise ValueError("Not a session file")
+        return
+
+    def _read_bin_header(self, magic):
+        hdr = magic + self._f.read(SESS_HDR_SIZE - 4)
+        (_, self.version, self.stacks, hdr_size, self.start_time,
+         material, thickness) = struct.unpack(SESS_HDR, hdr)
+        if self.version > VERSION:
+            raise ValueError("Unsupported session version %d" % self.version)
+        self.material = material.rstrip(b"\0").decode()
+        self.thickness = thickness.rstrip(b"\0").decode()
+        if hdr_size > SESS_HDR_SIZE:
+            self._f.read(hdr_size - SESS_HDR_SIZE)
+        return
+
+    def _read_text_header(self, magic):
+        line = (magic + self._f.readline()).decode()
+        self.version = 0
+        self.stacks = 2
+        self.start_time = json.loads(line[len("Time: "):])
+        self.material = self._f.readline().decode().strip()[len("Material: "):]
+        self.thickness = self._f.readline().decode().strip()[len("Thickness: "):]
+        line = self._f.readline().decode().strip()
+        if line.startswith("Stacks: "):
+            self.stacks = int(line[len("Stacks: "):])
+            self._f.readline()
+        return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.fmt == FMT_BIN:
+            p = self._next_bin()
+        else:
+            p = self._next_text()
+        if p is None:
+            raise StopIteration
+        return p
+
+    def _next_bin(self):
+        size = panel_hdr_size(self.stacks, self.version)
+        hdr = self._f.read(size)
+        if len(hdr) < size:
+            return None
+        pid, n, good, err, diffs, th, metrics = unpack_panel_hdr(self.version, hdr, 0,
+                                                                 self.stacks)
+        tc = data_typecode(self.version)
+        time = array('i', [0] * n)
+        data = [array(tc, [0] * n) for s in range(0, self.stacks)]
+        for a in [time] + data:
+            if n and self._f.readinto(memoryview(a)) != 4 * n:
+                raise ValueError("Truncated panel record")
+        return PanelRecord(pid, n, good, err, diffs, th, time, data,
+                           "mm" if tc == 'f' else "um", metrics)
+
+    def _next_text(self):
+        line = self._f.readline()
+        while line.strip() == b"":
+            if not line:
+                return None
+            line = self._f.readline()
+        pid = int(line.decode().strip()[len("ID: "):])
+        time = array('i', text_list(self._f.readline()))
+        data = [array('f', text_list(self._f.readline()))
+                for s in range(0, self.stacks)]
+        return PanelRecord(pid, len(time), None, None, None,
+                           float(self.thickness), time, data)
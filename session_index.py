@@ -0,0 +1,260 @@
+"""session_index.py
+
+Host side (CPython) reader for session files pulled off the SD card.
+
+A session file is memory mapped and indexed by panel ID from the record
+headers only, the samples are not parsed until a panel is asked for.
+Binary panels are returned as memoryviews into the map, without copying:
+
+    with SessionFile("/media/sd/2019-8-9-10-30_WPC_12.bin") as sess:
+        p = sess.panel(42)
+        print(p.diff1, max(p.data1))
+
+    lib = SessionLibrary("/media/sd")
+    for sess, p in lib.panels(material="WPC", thickness="12"):
+        ...
+
+Material and thickness come from the file names, so files of other
+materials are never opened. Text files are indexed the same way, but
+their panels are parsed into arrays when read, and have no verdict,
+diffs or metrics (None), see panel_format.
+
+    python3 session_index.py /media/sd [material] [thickness]
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+import panel_format
+from panel_format import (FMT_TEXT, FMT_BIN, EXTENSIONS, MAGIC, SESS_HDR,
+                          SESS_HDR_SIZE, PANEL_TAG, PanelRecord)
+
+
+class SessionFile:
+    """Memory mapped session file with an ID -> byte offset index
+
+    Panel memoryviews point into the map, drop them before close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+        self._f = open(path, "rb")
+        self._offsets = {}
+        self._ids = []
+        try:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._mm[0:4] == MAGIC:
+                self.fmt = FMT_BIN
+                self._index_bin()
+            elif self._mm[0:4] == b"Time":
+                self.fmt = FMT_TEXT
+                self._index_text()
+            else:
+                raise ValueError("Not a session file: %s" % path)
+        except:
+            # Nobody gets the object to close, so close it here
+            self.close()
+            raise
+        return
+
+    def _index_bin(self):
+        mm = self._mm
+        (_, self.version, self.stacks, hdr_size, self.start_time,
+         material, thickness) = struct.unpack_from(SESS_HDR, mm, 0)
+        if self.version > panel_format.VERSION:
+            raise ValueError("Unsupported session version %d" % self.version)
+        self.material = material.rstrip(b"\0").decode()
+        self.thickness = thickness.rstrip(b"\0").decode()
+        off = max(hdr_size, SESS_HDR_SIZE)
+        size = len(mm)
+        while off + panel_format.panel_hdr_size(self.stacks, self.version) <= size:
+            tag, pid, n = struct.unpack_from("<4sIH", mm, off)
+            if tag != PANEL_TAG:
+                raise ValueError("Bad panel record at %d" % off)
+            end = off + panel_format.record_size(self.stacks, n, self.version)
+            if end > size:
+                # Last record was cut short, e.g. power lost while writing
+                break
+            self._add(pid, off)
+            off = end
+        return
+
+    def _index_text(self):
+        mm = self._mm
+        with open(self.path, "rb") as f:
+            hdr = panel_format.SessionReader(f)
+        self.version = hdr.version
+        self.stacks = hdr.stacks
+        self.start_time = hdr.start_time
+        self.material = hdr.material
+        self.thickness = hdr.thickness
+        off = mm.find(b"\nID: ")
+        while off >= 0:
+            eol = mm.find(b"\n", off + 1)
+            if eol < 0:
+                break
+            self._add(int(mm[off + 5:eol]), off + 1)
+            off = mm.find(b"\nID: ", eol)
+        return
+
+    def _add(self, pid, off):
+        # A re-measured panel keeps its ID, the last record wins
+        if pid not in self._offsets:
+            self._ids.append(pid)
+        self._offsets[pid] = off
+        return
+
+    def ids(self):
+        return self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, pid):
+        return pid in self._offsets
+
+    def panel(self, pid):
+        """Panel record by ID, KeyError if the session has no such panel"""
+        off = self._offsets[pid]
+        if self.fmt == FMT_BIN:
+            return self._read_bin(off)
+        return self._read_text(off)
+
+    def nth(self, i):
+        """The i-th panel of the session, in file order"""
+        return self.panel(self._ids[i])
+
+    def __iter__(self):
+        for pid in self._ids:
+            yield self.panel(pid)
+
+    def _read_bin(self, off):
+        pid, n, good, err, diffs, th, metrics = panel_format.unpack_panel_hdr(
+            self.version, self._mm, off, self.stacks)
+        tc = panel_format.data_typecode(self.version)
+        mv = memoryview(self._mm)
+        off += panel_format.panel_hdr_size(self.stacks, self.version)
+        time = mv[off:off + 4 * n].cast('i')
+        data = []
+        for s in range(0, self.stacks):
+            off += 4 * n
+            data.append(mv[off:off + 4 * n].cast(tc))
+        return PanelRecord(pid, n, good, err, diffs, th, time, data,
+                           "mm" if tc == 'f' else "um", metrics)
+
+    def _read_text(self, off):
+        mm = self._mm
+        lines = []
+        eol = mm.find(b"\n", off)
+        for i in range(0, 1 + self.stacks):
+            start = eol + 1
+            eol = mm.find(b"\n", start)
+            if eol < 0:
+                eol = len(mm)
+            lines.append(mm[start:eol])
+        pid = int(mm[off + 4:mm.find(b"\n", off)])
+        time = array('i', panel_format.text_list(lines[0]))
+        data = [array('f', panel_format.text_list(line)) for line in lines[1:]]
+        return PanelRecord(pid, len(time), None, None, None,
+                           float(self.thickness), time, data)
+
+    def close(self):
+        try:
+            if self._mm is not None:
+                self._mm.close()
+        except BufferError:
+            # Panels still in use, the map goes when the last view does
+            pass
+        self._f.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def parse_filename(name):
+    """(material, thickness) from a session file name, None if not one
+
+    Names are Y-M-D-H-M_MATERIAL_THICKNESS.txt|.bin, as made by
+    MeasurementSession.get_filename().
+    """
+    base, ext = os.path.splitext(name)
+    if ext not in EXTENSIONS:
+        return None
+    parts = base.split("_")
+    if len(parts) != 3:
+        return None
+    return parts[1], parts[2]
+
+
+class SessionLibrary:
+    """All session files of a directory, selected by file name"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = []
+        for name in sorted(os.listdir(directory)):
+            info = parse_filename(name)
+            if info is not None:
+                self._files.append((name, info[0], info[1]))
+        return
+
+    def files(self, material=None, thickness=None):
+        for name, mat, th in self._files:
+            if material is not None and mat != material:
+                continue
+            if thickness is not None and float(th) != float(thickness):
+                continue
+            yield os.path.join(self.directory, name)
+
+    def sessions(self, material=None, thickness=None):
+        """Open SessionFiles one at a time, each is closed when the next opens"""
+        for path in self.files(material, thickness):
+            try:
+                sess = SessionFile(path)
+            except ValueError as err:
+                print("Skipping %s: %s" % (path, err), file=sys.stderr)
+                continue
+            try:
+                yield sess
+            finally:
+                sess.close()
+
+    def panels(self, material=None, thickness=None):
+        """(session, panel) for every panel of a material and thickness"""
+        for sess in self.sessions(material, thickness):
+            for p in sess:
+                yield sess, p
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 1
+    material = argv[2] if len(argv) > 2 else None
+    thickness = argv[3] if len(argv) > 3 else None
+    lib = SessionLibrary(argv[1])
+    for sess in lib.sessions(material, thickness):
+        if sess.fmt == FMT_TEXT:
+            judged = "not judged"
+        else:
+            good = 0
+            for p in sess:
+                good += 1 if p.good else 0
+                del p
+            judged = "%d good" % good
+        print("%s: %s %smm, %d panels, %s"
+              % (os.path.basename(sess.path), sess.material, sess.thickness,
+                 len(sess), judged))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -26,6 +26,12 @@ try:
 except ImportError:
     import ustruct as struct
 
+try:
+    from uerrno import ETIMEDOUT
+except ImportError:
+    from errno import ETIMEDOUT
+
+import utime
 from machine import I2C, Pin
 from micropython import const
 
@@ -34,6 +40,30 @@ TEMPERATURE = const(0xf3)
 _RESET = const(0xfe)
 _READ_USER1 = const(0xe7)
 _USER1_VAL = const(0x3a)
+# Temperature measured during the last humidity conversion
+_TEMP_PREV = const(0xe0)
+# States of the non-blocking measurement, see SI7021.start()
+IDLE = const(0)
+CONVERTING = const(1)
+READY = const(2)
+ERROR = const(3)
+# A humidity and temperature conversion takes up to 23ms
+CONVERSION_TIMEOUT = const(100)
+# The sensor is back from a reset within 15ms
+RESET_TIMEOUT = const(100)
+
+
+def _crc8(data, n):
+    """Checksum of the first n bytes of data, x^8 + x^5 + x^4 + 1"""
+    crc = 0
+    for i in range(0, n):
+        crc ^= data[i]
+        for bit in range(0, 8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x31) & 0xff
+            else:
+                crc = (crc << 1) & 0xff
+    return crc
 
 class SI7021:
     """
@@ -44,9 +74,10 @@ class SI7021:
 
     def __init__(self, scl, sda, address=0x40):
         self._i2c = I2C(scl=Pin(scl), sda=Pin(sda))
-	self._addr = address
-	self._command(_RESET)
+        self._addr = address
+        self._command(_RESET)
         # Make sure the USER1 settings are correct.
+        start = utime.ticks_ms()
         while True:
             # While restarting, the sensor doesn't respond to reads or writes.
             try:
@@ -55,20 +86,29 @@ class SI7021:
                 self._i2c.readfrom_into(self._addr, data)
                 value = data[0]
             except OSError:
-                pass
+                # A wedged sensor must not hang the caller, e.g. the GUI
+                if utime.ticks_diff(utime.ticks_ms(), start) > RESET_TIMEOUT:
+                    raise OSError(ETIMEDOUT)
             else:
                 break
         if value != _USER1_VAL:
             raise RuntimeError("bad USER1 register (%x!=%x)" % (
                 value, _USER1_VAL))
         self._measurement = 0
+        self._buf = bytearray(3)
+        self.state = IDLE
+        self.error = None
+        self.temperature = None
+        self.relative_humidity = None
+        self._t_start = 0
 
     def _command(self, command):
         self._i2c.writeto(self._addr, struct.pack('B', command))
 
-    def _data(self):
-        data = bytearray(3)
+    def _data(self, check_crc=False):
+        data = self._buf
         data[0] = 0xff
+        start = utime.ticks_ms()
         while True:
             # While busy, the sensor doesn't respond to reads.
             try:
@@ -78,8 +118,12 @@ class SI7021:
             else:
                 if data[0] != 0xff: # Check if read succeeded.
                     break
-        value, checksum = struct.unpack('>HB', data)
-        return value
+            if utime.ticks_diff(utime.ticks_ms(), start) > CONVERSION_TIMEOUT:
+                self._measurement = 0
+                raise OSError(ETIMEDOUT)
+        if check_crc and _crc8(data, 2) != data[2]:
+            raise RuntimeError("bad checksum")
+        return (data[0] << 8) | data[1]
 
     def read_relative_humidity(self):
         """The measured relative humidity in percent."""
@@ -95,6 +139,87 @@ class SI7021:
         self._measurement = 0
         return (((value * 175.72) / 65536.0) - 46.85)
 
+    def read_both(self, check_crc=False):
+        """Temperature in degrees Celcius and relative humidity in percent.
+
+        One humidity conversion, the sensor measures the temperature for
+        it too, which is then read with _TEMP_PREV without converting
+        again. With check_crc a humidity reading with a bad checksum
+        raises RuntimeError, the temperature read has no checksum. A
+        conversion already started with start() is waited for instead of
+        starting another. Raises OSError if the sensor does not answer.
+        """
+        if self.state != CONVERTING:
+            self.start()
+        while self.poll(check_crc) == CONVERTING:
+            pass
+        if self.state == ERROR:
+            raise self.error
+        return (self.temperature, self.relative_humidity)
+
+    def start(self):
+        """Start a humidity and temperature conversion, returns at once.
+
+        Call poll() later to collect it. If the sensor does not take the
+        command the state is ERROR.
+        """
+        if self.state == CONVERTING:
+            return
+        self._measurement = 0
+        try:
+            self.start_measurement(HUMIDITY)
+        except OSError as err:
+            self._fail(err)
+            return
+        self._t_start = utime.ticks_ms()
+        self.error = None
+        self.state = CONVERTING
+        return
+
+    def poll(self, check_crc=False):
+        """Collect the conversion started by start() if it is done.
+
+        Tries one read and never waits. Returns the state: CONVERTING
+        while the sensor is busy, READY with temperature and
+        relative_humidity updated, or ERROR with error set after a bad
+        checksum or no answer within CONVERSION_TIMEOUT ms.
+        """
+        if self.state != CONVERTING:
+            return self.state
+        data = self._buf
+        data[0] = 0xff
+        try:
+            # While busy, the sensor doesn't respond to reads.
+            self._i2c.readfrom_into(self._addr, data)
+        except OSError:
+            pass
+        if data[0] == 0xff:
+            if utime.ticks_diff(utime.ticks_ms(), self._t_start) > CONVERSION_TIMEOUT:
+                self._fail(OSError(ETIMEDOUT))
+            return self.state
+        self._measurement = 0
+        if check_crc and _crc8(data, 2) != data[2]:
+            self._fail(RuntimeError("bad checksum"))
+            return self.state
+        rh = (data[0] << 8) | data[1]
+        try:
+            self._command(_TEMP_PREV)
+            self._i2c.readfrom_into(self._addr, memoryview(data)[0:2])
+        except OSError as err:
+            self._fail(err)
+            return self.state
+        temp = (data[0] << 8) | data[1]
+        self.temperature = (((temp * 175.72) / 65536.0) - 46.85)
+        self.relative_humidity = (((rh * 125.0) / 65536.0) - 6.0)
+        self.state = READY
+        return self.state
+
+    def _fail(self, err):
+        self._measurement = 0
+        self.error = err
+        self.state = ERROR
+        return
+
     def start_measurement(self, what):
         """
         Starts a measurement.
@@ -0,0 +1,17 @@
+"""TFTFeatherWing stand-in, a display nobody looks at and an untouched
+touch screen"""
+
+
+class TFTFeatherWing:
+
+    def __init__(self, tft_mhz=24, **kwargs):
+        return
+
+    def init(self):
+        return
+
+    def flush(self, disp_drv, area, color_p):
+        return
+
+    def read(self, indev_drv, data):
+        return False
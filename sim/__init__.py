@@ -0,0 +1,132 @@
+"""sim
+
+Host side (CPython) simulation of the laser measurement station, so the
+MCU modules run unmodified on a Linux box:
+
+    import sim
+    sim.install()
+    import laser_ctrl
+    laser = laser_ctrl.LaserCtrl()
+
+install() puts stand-ins for the MicroPython modules (machine, utime, uos,
+network, _thread, uselect, ...) into sys.modules and maps the device file
+system ("/sd", "/time") into a host directory. The amplifiers on UART(2)
+are emulated by sim.amp.AmpEmulator, which answers M0, AW, SW and SR at
+the modelled baud rate and plays a scripted sim.amp.Scenario of panels.
+The SI7021 on the I2C bus is sim.devices.SI7021Device. lvgl is headless
+(sim.lvgl), lvgl.task_handler() runs the GUI tasks. upload_server, a
+sim.server.UploadServer on a local port, stands in for the data server
+of uploader.Uploader; the usocket stand-in routes every LAN address to
+it, so nothing is sent out of the host. Set upload_server.down or
+sim.network.ap_up to script outages.
+
+Time is the host clock, so latencies and rates measured in the simulation
+are real ones.
+
+    python3 -m sim [panels]
+
+runs a measuring session against the default scenario, and
+
+    python3 -m sim.uploads
+
+checks the uploader against upload_server through WiFi and server
+outages.
+"""
+import builtins
+import errno
+import os
+import random
+import struct
+import sys
+import tempfile
+
+_installed = False
+# Host directory holding the device file system
+root = None
+# The emulated devices, set by install()
+amps = None
+th_sensor = None
+upload_server = None
+_open = builtins.open
+
+
+def device_path(path):
+    """Host path of a device path, or path itself if it is not one
+
+    Absolute paths in a mounted directory ("/sd/...") and files at the top
+    of the device file system ("/time") are mapped under root.
+    """
+    if not isinstance(path, str) or not path.startswith("/") or root is None:
+        return path
+    if path.startswith(root):
+        return path
+    parts = path.strip("/").split("/")
+    from sim import uos
+    if len(parts) == 1 or "/" + parts[0] in uos.mounts:
+        return os.path.join(root, *parts)
+    return path
+
+
+def _device_open(file, *args, **kwargs):
+    return _open(device_path(file), *args, **kwargs)
+
+
+def install(scenario=None, root_dir=None):
+    """Install the stand-in modules, returns the amplifier emulator
+
+    scenario is the sim.amp.Scenario played by the amplifiers, root_dir
+    the host directory for the device files (a new temporary directory if
+    not given).
+    """
+    global _installed, root, amps, th_sensor, upload_server
+    from sim import (machine, utime, uos, network, micropython, ujson, uselect,
+                     ntptime, esp, uthread, amp, devices, lvgl, lvesp32,
+                     TFTFeatherWing, usocket)
+    from sim.server import UploadServer
+    if root_dir is None:
+        root_dir = tempfile.mkdtemp(prefix="laser_sim_")
+    root = os.path.abspath(root_dir)
+    os.makedirs(root, exist_ok=True)
+    modules = {
+        "machine": machine,
+        "utime": utime,
+        "uos": uos,
+        "network": network,
+        "micropython": micropython,
+        "ujson": ujson,
+        "uselect": uselect,
+        "ntptime": ntptime,
+        "esp": esp,
+        "_thread": uthread,
+        "ustruct": struct,
+        "usocket": usocket,
+        "uerrno": errno,
+        "urandom": random,
+        "lvgl": lvgl,
+        "lvesp32": lvesp32,
+        "TFTFeatherWing": TFTFeatherWing,
+    }
+    sys.modules.update(modules)
+    builtins.open = _device_open
+    amps = amp.AmpEmulator(scenario)
+    machine.attach_uart(2, amps)
+    th_sensor = devices.SI7021Device()
+    machine.i2c_devices[0x40] = th_sensor
+    if upload_server is None:
+        upload_server = UploadServer()
+        upload_server.start()
+    usocket.server = upload_server
+    _installed = True
+    return amps
+
+
+def uninstall():
+    """Put builtins.open back and stop the server, the stand-in modules
+    stay imported"""
+    global _installed, upload_server
+    builtins.open = _open
+    if upload_server is not None:
+        upload_server.stop()
+        upload_server = None
+    _installed = False
+    return
@@ -0,0 +1,37 @@
+"""python3 -m sim [panels] [root_dir]
+
+Measures panels (default 3) of the default scenario with the unmodified
+LaserCtrl and prints the verdicts and the acquisition rate.
+"""
+import sys
+
+import sim
+
+
+def main(argv):
+    panels = int(argv[0]) if argv else 3
+    sim.install(root_dir=argv[1] if len(argv) > 1 else None)
+    import machine
+    import uos
+    import laser_ctrl
+    from sim import station
+    # LaserMCU mounts the card on the device
+    uos.mount(machine.SDCard(slot=3), laser_ctrl.SD_FILE)
+    laser = laser_ctrl.LaserCtrl()
+    sensor = sim.th_sensor
+    print("Device files in", sim.root)
+    print("T: %0.2f H: %0.2f" % (sensor.temperature, sensor.humidity))
+    filename, results = station.run_session(laser, panels)
+    for r in results:
+        print("Panel %d: %d samples, %s, diff %s mm, %0.1f Hz "
+              "(interval %0.0f us, std %0.0f us, max %d us)%s" % (
+                  r["id"], r["samples"], "good" if r["good"] else "bad",
+                  "/".join(["%0.3f" % (d / 1000) for d in r["diff_um"]]), r["rate_hz"],
+                  r["period_mean_us"], r["period_std_us"], r["period_max_us"],
+                  "" if r["err"] is None else ", err: " + r["err"]))
+    print("Session written to", sim.device_path(laser_ctrl.SD_FILE + "/" + filename))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,238 @@
+"""Laser amplifier emulator and scripted panel scenarios
+
+AmpEmulator stands behind machine.UART(2). It answers the commands
+LaserCtrl sends, one at a time in the order received:
+
+    M0\\r\\n              -> M0,+DD.DDD,...\\r\\n, one field per amplifier
+    AW,ccc,data\\r\\n     -> AW\\r\\n
+    SW,aa,ccc,data\\r\\n  -> SW,aa,ccc\\r\\n
+    SR,aa,ccc\\r\\n       -> SR,aa,ccc,data\\r\\n
+    anything else       -> ER,cc,01\\r\\n
+
+Each byte takes 10 bit times both ways at the configured baud rate, and
+every command takes proc_s to handle, so a request/reply round trip and
+the gain of pipelining are modelled. Readings come from a Scenario.
+"""
+import math
+import random
+import time as _time
+from collections import deque
+
+NO_TARGET = -99.999
+_SHIFT_VALUE = "067"
+_ZERO_SHIFT = "001"
+_LASER_STOP = "100"
+
+
+class PanelProfile:
+    """One panel passing the stacks
+
+    thickness in mm, the panel moves at speed_mm_s. warp_um is the bow
+    of the panel from its ends to the middle, noise_um the sensor noise
+    (std dev), outlier_rate the chance of a reading being off by
+    outlier_mm. The trailing edge leaves stack k skew_s * k later than
+    stack 0.
+    """
+
+    def __init__(self, thickness=12.0, length_mm=2440, speed_mm_s=400,
+                 warp_um=150, noise_um=5, outlier_rate=0.01, outlier_mm=3.0,
+                 skew_s=0.05, seed=1):
+        self.thickness = thickness
+        self.length_mm = length_mm
+        self.speed_mm_s = speed_mm_s
+        self.warp_um = warp_um
+        self.noise_um = noise_um
+        self.outlier_rate = outlier_rate
+        self.outlier_mm = outlier_mm
+        self.skew_s = skew_s
+        self._rand = random.Random(seed)
+        return
+
+    def duration_s(self, stacks=2):
+        return self.length_mm / self.speed_mm_s + self.skew_s * (stacks - 1)
+
+    def stack_reading(self, t, stack):
+        """Thickness seen by a stack t s after the leading edge, None if
+        the panel is not under it"""
+        t -= self.skew_s * stack
+        x = t * self.speed_mm_s
+        if t < 0 or x > self.length_mm:
+            return None
+        th = self.thickness
+        th += self.warp_um / 1000 * math.sin(math.pi * x / self.length_mm) * (1 - 0.2 * stack)
+        th += self._rand.gauss(0, self.noise_um / 1000)
+        if self._rand.random() < self.outlier_rate:
+            th += self.outlier_mm if self._rand.random() < 0.5 else -self.outlier_mm
+        return th
+
+
+def default_panels(thickness=12.0):
+    """A good panel, a badly warped one and a noisy one with outliers"""
+    return [
+        PanelProfile(thickness, warp_um=150, seed=1),
+        PanelProfile(thickness, warp_um=800, seed=2),
+        PanelProfile(thickness, length_mm=1830, warp_um=200, noise_um=40,
+                     outlier_rate=0.05, skew_s=0.2, seed=3),
+    ]
+
+
+class Scenario:
+    """Panels going through the station one after another
+
+    lead_in_s of nothing before the first panel, gap_s between panels,
+    then nothing, or the panels again if loop is set.
+    """
+
+    def __init__(self, panels=None, lead_in_s=0.3, gap_s=1.0, loop=False, stacks=2):
+        if panels is None:
+            panels = default_panels()
+        self.panels = panels
+        self.lead_in_s = lead_in_s
+        self.gap_s = gap_s
+        self.loop = loop
+        self.stacks = stacks
+        self._starts = []
+        t = lead_in_s
+        for p in panels:
+            self._starts.append(t)
+            t += p.duration_s(stacks) + gap_s
+        self.period_s = t
+        return
+
+    def stack_readings(self, t):
+        """Thickness per stack at t s into the scenario, None for no panel"""
+        if self.loop and t >= self.period_s:
+            t = self.lead_in_s + (t - self.lead_in_s) % (self.period_s - self.lead_in_s)
+        out = [None] * self.stacks
+        for start, p in zip(self._starts, self.panels):
+            if start <= t < start + p.duration_s(self.stacks):
+                for s in range(0, self.stacks):
+                    out[s] = p.stack_reading(t - start, s)
+                break
+        return out
+
+
+class AmpEmulator:
+    """Amplifiers answering on a UART, see the module doc
+
+    The two amplifiers of a stack each report half of the thickness,
+    by default there are two for every stack of the scenario.
+    """
+
+    def __init__(self, scenario=None, amps=None, baudrate=38400, proc_s=0.002):
+        self.scenario = scenario if scenario is not None else Scenario()
+        if amps is None:
+            amps = 2 * self.scenario.stacks
+        self.amps = amps
+        self.proc_s = proc_s
+        self.settings = {}
+        self.shift = [0.0] * amps
+        self.requests = 0
+        self.set_baudrate(baudrate)
+        self.restart()
+        return
+
+    def set_baudrate(self, baudrate):
+        self.byte_s = 10 / baudrate
+        return
+
+    def restart(self, scenario=None):
+        """Start the scenario (again) from now"""
+        if scenario is not None:
+            self.scenario = scenario
+        self.t0 = _time.monotonic()
+        self._in = b""
+        self._tx_until = self.t0
+        self._busy_until = self.t0
+        self._pending = deque()
+        self._rx = bytearray()
+        return
+
+    # UART side
+    def receive(self, data):
+        now = _time.monotonic()
+        self._tx_until = max(self._tx_until, now) + len(data) * self.byte_s
+        self._in += data
+        while b"\n" in self._in:
+            line, self._in = self._in.split(b"\n", 1)
+            start = max(self._tx_until, self._busy_until) + self.proc_s
+            reply = self._handle(line.strip().decode("ascii", "replace"), start)
+            self._pending.append((start, reply))
+            self._busy_until = start + len(reply) * self.byte_s
+        return
+
+    def _arrive(self):
+        now = _time.monotonic()
+        while self._pending:
+            start, reply = self._pending[0]
+            n = int((now - start) / self.byte_s)
+            if n <= 0:
+                break
+            if n >= len(reply):
+                self._rx += reply
+                self._pending.popleft()
+            else:
+                self._rx += reply[0:n]
+                self._pending[0] = (start + n * self.byte_s, reply[n:])
+                break
+        return
+
+    def available(self):
+        self._arrive()
+        return len(self._rx)
+
+    def peek(self, n):
+        self._arrive()
+        return bytes(self._rx[0:n])
+
+    def take(self, n):
+        self._arrive()
+        data = bytes(self._rx[0:n])
+        del self._rx[0:n]
+        return data
+
+    def next_arrival_s(self):
+        if self._rx:
+            return 0
+        if not self._pending:
+            return None
+        return max(0, self._pending[0][0] + self.byte_s - _time.monotonic())
+
+    # Amplifier side
+    def readings(self, t):
+        """Values of all amplifiers t s into the scenario, in mm"""
+        if self.settings.get(_LASER_STOP) == "1":
+            return [NO_TARGET] * self.amps
+        stacks = self.scenario.stack_readings(t)
+        out = []
+        for amp in range(0, self.amps):
+            th = stacks[amp // 2] if amp // 2 < len(stacks) else None
+            if th is None:
+                out.append(NO_TARGET)
+            else:
+                out.append(max(-99.999, min(99.999, th / 2 + self.shift[amp])))
+        return out
+
+    def _handle(self, line, t):
+        fields = line.split(",")
+        cmd = fields[0]
+        if cmd == "M0" and len(fields) == 1:
+            self.requests += 1
+            values = self.readings(t - self.t0)
+            return ("M0," + ",".join("%+07.3f" % v for v in values) + "\r\n").encode()
+        if cmd == "AW" and len(fields) == 3:
+            self.settings[fields[1]] = fields[2]
+            return b"AW\r\n"
+        if cmd == "SW" and len(fields) == 4:
+            amp = int(fields[1])
+            if fields[2] == _SHIFT_VALUE:
+                self.settings[(amp, _SHIFT_VALUE)] = float(fields[3])
+            elif fields[2] == _ZERO_SHIFT and fields[3] == "1":
+                self.shift[amp] += self.settings.get((amp, _SHIFT_VALUE), 0.0)
+            else:
+                self.settings[(amp, fields[2])] = fields[3]
+            return ("SW,%s,%s\r\n" % (fields[1], fields[2])).encode()
+        if cmd == "SR" and len(fields) == 3:
+            value = self.settings.get((int(fields[1]), fields[2]), "+00000")
+            return ("SR,%s,%s,%s\r\n" % (fields[1], fields[2], value)).encode()
+        return ("ER,%s,01\r\n" % cmd[0:2]).encode()
@@ -0,0 +1,271 @@
+"""Benchmark suite on the simulator
+
+    python3 -m sim.benchmarks [-o results.json] [-b baseline.json]
+                              [-t percent] [--quick]
+
+Runs the bench.py timings and a full wait_for_panel per panel length
+against the emulated amplifiers and SD card, plus the GUI plotting of a
+measured panel on the headless lvgl, and with -o writes the metrics as
+JSON.
+With a baseline, every tracked metric is compared against it and the
+exit status is 1 if one regressed by more than its threshold.
+
+Metric names are "<metric>[<panel length>]"; times are the best of a
+few runs in us. THRESHOLDS holds the tracked metrics and the allowed
+regression in percent, -t overrides all of them. The counts (chart
+calls, point writes) are the same on every run of the same code and are
+gated exactly. Host times swing by tens of percent between identical
+runs, so they are only gated on large changes, and never if they moved
+by less than their NOISE_FLOOR_US.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import sim
+
+# Tracked metric -> allowed regression in percent
+THRESHOLDS = {
+    "plot_chart_calls": 0,
+    "plot_point_writes": 0,
+    "acq_rate_hz": 10,
+    "acq_jitter_us": 100,
+    "move_mean_us": 100,
+    "judgment_us": 100,
+    "write_panel_us": 100,
+    "plot_us": 100,
+    "edge_to_verdict_us": 100,
+    "edge_to_written_us": 100,
+}
+# Time metric -> changes in us that are host noise, never a regression.
+# Set from the spread of identical runs, well below the baselines, so a
+# 10x slowdown of the longest panel fails.
+NOISE_FLOOR_US = {
+    "acq_jitter_us": 2000,
+    "move_mean_us": 300,
+    "judgment_us": 50,
+    "write_panel_us": 200,
+    "plot_us": 500,
+    "edge_to_verdict_us": 2000,
+    "edge_to_written_us": 2000,
+}
+# Metrics where a larger value is better
+HIGHER_IS_BETTER = ("acq_rate_hz",)
+QUICK_LENGTHS = (20, 100)
+# The emulated panels move at this speed
+SPEED_MM_S = 400
+
+
+def _key(metric, n):
+    return "%s[%s]" % (metric, n)
+
+
+def bench_processing(metrics, lengths, repeat):
+    import bench
+    for n, ref_us, new_us in bench.bench_move_mean(lengths, repeat):
+        metrics[_key("move_mean_us", n)] = new_us
+        metrics[_key("move_mean_ref_us", n)] = ref_us
+    for n, python_us, ulab_us in bench.bench_backends(lengths, repeat):
+        metrics[_key("move_mean_python_us", n)] = python_us
+        if ulab_us is not None:
+            metrics[_key("move_mean_ulab_us", n)] = ulab_us
+    for n, batch_us, online_us in bench.bench_judgment(lengths, repeat):
+        metrics[_key("judgment_us", "batch%d" % n)] = batch_us
+        metrics[_key("judgment_us", n)] = online_us
+    return
+
+
+def bench_io(metrics, laser, lengths, repeat):
+    import bench
+    import laser_ctrl
+    for pipeline, rate, jitter, worst in bench.bench_acquisition(laser):
+        name = "pipelined" if pipeline else "plain"
+        metrics[_key("acq_rate_hz", name)] = rate
+        metrics[_key("acq_jitter_us", name)] = jitter
+        metrics[_key("acq_max_interval_us", name)] = worst
+    for n, fmt, us in bench.bench_write_panel(laser, lengths, repeat):
+        name = "bin" if fmt == laser_ctrl.FMT_BIN else "text"
+        metrics[_key("write_panel_us", "%s%d" % (name, n))] = us
+    return
+
+
+def bench_edge_to_verdict(metrics, amps, laser, lengths, rate):
+    """A real wait_for_panel per panel length
+
+    The emulated panel is sized to give n samples at the measured rate,
+    lengths too short for the moving mean are skipped. Times are from the last sample to the verdict (judged_cb) and to
+    wait_for_panel returning.
+    """
+    import _thread
+    import utime
+    from sim.amp import Scenario, PanelProfile
+    import laser_ctrl
+    lock = _thread.allocate_lock()
+    verdict = [0]
+
+    def judged_cb(panel):
+        verdict[0] = utime.ticks_us()
+    laser.start_session("BENCH", "12")
+    filename = laser_ctrl.SD_FILE + "/" + laser._session.get_filename()
+    try:
+        for n in lengths:
+            if n <= laser_ctrl.FILTER_SIZE:
+                continue
+            profile = PanelProfile(12.0, length_mm=SPEED_MM_S * n / rate,
+                                   speed_mm_s=SPEED_MM_S, skew_s=0)
+            amps.restart(Scenario([profile], lead_in_s=0.2, gap_s=0.5))
+            panel = laser._session.new_panel()
+            laser.wait_for_panel(panel, lock, judged_cb)
+            done = utime.ticks_us()
+            if panel.err is not None:
+                print("n=%4d %s" % (n, panel.err))
+                continue
+            last = utime.ticks_add(panel._t_start, panel._time[panel._c - 1])
+            to_verdict = utime.ticks_diff(verdict[0], last)
+            to_written = utime.ticks_diff(done, last)
+            print("n=%4d got %4d samples, edge to verdict %9.3fms, to written %9.3fms"
+                  % (n, panel._in, to_verdict / 1000, to_written / 1000))
+            metrics[_key("edge_to_verdict_us", n)] = to_verdict
+            metrics[_key("edge_to_written_us", n)] = to_written
+            metrics[_key("edge_samples", n)] = panel._in
+    finally:
+        laser.end_session()
+        import uos
+        uos.remove(filename)
+    return
+
+
+def bench_plot(metrics, gui, lengths, repeat):
+    """Time LaserGui._check_wait_panel_cb plotting a measured panel"""
+    import bench
+    import laser_ctrl
+    laser = gui.laser
+    laser.start_session("BENCH", "12")
+    filename = laser_ctrl.SD_FILE + "/" + laser._session.get_filename()
+    chart = gui.body._chart
+    try:
+        for n in lengths:
+            panel = laser._session.new_panel()
+            bench.feed_panel(panel, n)
+            laser._judgment(panel)
+            best = None
+            for r in range(0, repeat):
+                calls = chart.calls
+                writes = chart.point_writes
+                t = time.perf_counter()
+                gui._check_wait_panel_cb(None)
+                us = (time.perf_counter() - t) * 1000000
+                if best is None or us < best:
+                    best = us
+                calls = chart.calls - calls
+                writes = chart.point_writes - writes
+            print("n=%4d plot %9.3fms, %d chart calls, %d point writes"
+                  % (n, best / 1000, calls, writes))
+            metrics[_key("plot_us", n)] = best
+            metrics[_key("plot_chart_calls", n)] = calls
+            metrics[_key("plot_point_writes", n)] = writes
+    finally:
+        laser.end_session()
+        import uos
+        uos.remove(filename)
+    return
+
+
+def compare(metrics, baseline, threshold=None):
+    """Regressions of the tracked metrics against baseline
+
+    Returns a list of (name, baseline, value, change in percent).
+    """
+    regressions = []
+    for name, value in sorted(metrics.items()):
+        metric = name.split("[")[0]
+        if metric not in THRESHOLDS or name not in baseline:
+            continue
+        base = baseline[name]
+        if not base:
+            continue
+        change = (value - base) * 100 / base
+        if metric in HIGHER_IS_BETTER:
+            change = -change
+        limit = THRESHOLDS[metric] if threshold is None else threshold
+        flag = ""
+        noise = abs(value - base) < NOISE_FLOOR_US.get(metric, 0)
+        if change > limit and not noise:
+            regressions.append((name, base, value, change))
+            flag = "  REGRESSION (limit %g%%)" % limit
+        print("%-36s %12.1f -> %12.1f %+7.1f%%%s" % (name, base, value, change, flag))
+    return regressions
+
+
+def run(lengths=None, repeat=7, root_dir=None):
+    """Run the suite, returns the metrics dict
+
+    lengths defaults to bench.PANEL_LENGTHS.
+    """
+    amps = sim.install(root_dir=root_dir)
+    import lvgl
+    import gui_ctrl
+    import bench
+    if lengths is None:
+        lengths = bench.PANEL_LENGTHS
+    metrics = {}
+    print("== processing")
+    bench_processing(metrics, lengths, repeat)
+    print("== GUI")
+    gui = gui_ctrl.LaserGui()
+    laser = gui.laser
+    laser.on()
+    lvgl.task_handler()
+    print("== acquisition and SD")
+    bench_io(metrics, laser, lengths, repeat)
+    print("== trailing edge to verdict")
+    bench_edge_to_verdict(metrics, amps, laser, lengths,
+                          metrics[_key("acq_rate_hz", "plain")])
+    print("== plotting")
+    bench_plot(metrics, gui, lengths, repeat)
+    return metrics
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python3 -m sim.benchmarks")
+    parser.add_argument("-o", "--output",
+                        help="results file, only written if given")
+    parser.add_argument("-b", "--baseline", help="results file to compare against")
+    parser.add_argument("-t", "--threshold", type=float,
+                        help="allowed regression in percent for every tracked metric")
+    parser.add_argument("-r", "--repeat", type=int, default=7)
+    parser.add_argument("--quick", action="store_true",
+                        help="only panel lengths %s" % (QUICK_LENGTHS,))
+    args = parser.parse_args(argv)
+    metrics = run(QUICK_LENGTHS if args.quick else None, args.repeat)
+    import bench
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "lengths": list(QUICK_LENGTHS if args.quick else bench.PANEL_LENGTHS),
+            "repeat": args.repeat,
+        },
+        "thresholds": THRESHOLDS,
+        "metrics": metrics,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("Results written to", args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["metrics"]
+        print("== against", args.baseline)
+        regressions = compare(metrics, baseline, args.threshold)
+        if regressions:
+            print("%d metric(s) regressed" % len(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,95 @@
+"""Emulated I2C devices"""
+import time as _time
+
+_RESET = 0xfe
+_READ_USER1 = 0xe7
+_USER1_VAL = 0x3a
+_RH_HOLD = 0xe5
+_RH = 0xf5
+_TEMP_HOLD = 0xe3
+_TEMP = 0xf3
+_TEMP_PREV = 0xe0
+
+
+def crc8(data):
+    """SI7021 checksum, x^8 + x^5 + x^4 + 1 starting from 0"""
+    crc = 0
+    for b in data:
+        crc ^= b
+        for _ in range(0, 8):
+            crc = ((crc << 1) ^ 0x31) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+    return crc
+
+
+class SI7021Device:
+    """SI7021 temperature and humidity sensor
+
+    Reads are NAKed (OSError) during the reset and while a conversion
+    runs. A humidity conversion also measures the temperature, which 0xE0
+    then returns without a new conversion. temperature and humidity are
+    the environment being measured, conversions counts the conversions
+    started.
+    """
+
+    def __init__(self, temperature=22.5, humidity=45.0, reset_s=0.015,
+                 rh_s=0.012, temp_s=0.011):
+        self.temperature = temperature
+        self.humidity = humidity
+        self.reset_s = reset_s
+        self.rh_s = rh_s
+        self.temp_s = temp_s
+        self.conversions = 0
+        self._busy_until = 0
+        self._reply = b""
+        self._last_temp = 0
+        return
+
+    def _busy(self):
+        if _time.monotonic() < self._busy_until:
+            raise OSError(19)
+        return
+
+    def _code_rh(self):
+        code = int((self.humidity + 6) * 65536 / 125) & 0xfffc
+        return min(code, 0xfffc)
+
+    def _code_temp(self):
+        return int((self.temperature + 46.85) * 65536 / 175.72) & 0xfffc
+
+    def _word(self, code):
+        data = bytes([code >> 8, code & 0xff])
+        return data + bytes([crc8(data)])
+
+    def write(self, data):
+        self._busy()
+        cmd = data[0]
+        now = _time.monotonic()
+        if cmd == _RESET:
+            self._busy_until = now + self.reset_s
+            self._reply = b""
+        elif cmd == _READ_USER1:
+            self._reply = bytes([_USER1_VAL])
+        elif cmd in (_RH, _RH_HOLD):
+            self.conversions += 1
+            self._busy_until = now + self.rh_s + self.temp_s
+            self._last_temp = self._code_temp()
+            self._reply = self._word(self._code_rh())
+        elif cmd in (_TEMP, _TEMP_HOLD):
+            self.conversions += 1
+            self._busy_until = now + self.temp_s
+            self._last_temp = self._code_temp()
+            self._reply = self._word(self._last_temp)
+        elif cmd == _TEMP_PREV:
+            # No checksum for the previous temperature
+            self._reply = self._word(self._last_temp)[0:2]
+        else:
+            raise OSError(5)
+        return
+
+    def read_into(self, buf):
+        self._busy()
+        n = min(len(buf), len(self._reply))
+        buf[0:n] = self._reply[0:n]
+        for i in range(n, len(buf)):
+            buf[i] = 0xff
+        return
@@ -0,0 +1 @@
+"""lvesp32 stand-in, call lvgl.task_handler() to run the GUI tasks"""
@@ -0,0 +1,366 @@
+"""Headless lvgl stand-in
+
+Enough of the lvgl 6.0 binding for gui_ctrl to build its screens and run
+its tasks without a display. Widgets accept any call; the chart keeps its
+points like lv_chart in 6.0, where set_next shifts the whole series by
+one. task_handler() runs the due tasks, as lvesp32 does on the device.
+"""
+import time as _time
+
+
+class _Enum:
+    """Any upper case attribute is an int constant"""
+
+    def __init__(self, name):
+        self._name = name
+        self._values = {}
+        return
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._values.setdefault(name, len(self._values))
+
+
+class _Any:
+    """Structs (styles, drivers) taking any field"""
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        value = _Any()
+        setattr(self, name, value)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return _Any()
+
+
+class obj:
+    STYLE = _Enum("STYLE")
+
+    def __init__(self, parent=None, copy=None):
+        self._parent = parent
+        self._hidden = False
+        self._text = ""
+        self._styles = {}
+        self._width = 480 if parent is None else parent.get_width()
+        self._height = 320 if parent is None else parent.get_height()
+        return
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
+    def get_width(self):
+        return self._width
+
+    def get_height(self):
+        return self._height
+
+    def set_size(self, w, h):
+        self._width = w
+        self._height = h
+
+    def set_width(self, w):
+        self._width = w
+
+    def set_height(self, h):
+        self._height = h
+
+    def set_hidden(self, hidden):
+        self._hidden = hidden
+
+    def get_hidden(self):
+        return self._hidden
+
+    def set_text(self, text):
+        self._text = text
+
+    def get_text(self):
+        return self._text
+
+    def get_style(self, which=0):
+        return self._styles.setdefault(which, style_t())
+
+    def set_style(self, which, style=None):
+        self._styles[which] = style
+
+
+class label(obj):
+    pass
+
+
+class btn(obj):
+    STYLE = _Enum("STYLE")
+
+
+class cont(obj):
+    pass
+
+
+class ta(obj):
+    pass
+
+
+class roller(obj):
+    MODE = _Enum("MODE")
+
+    def __init__(self, parent=None, copy=None):
+        super().__init__(parent, copy)
+        self._selected = 0
+        return
+
+    def set_selected(self, sel, anim=False):
+        self._selected = sel
+
+    def get_selected(self):
+        return self._selected
+
+
+class kb(obj):
+    pass
+
+
+class preload(obj):
+    pass
+
+
+class calendar(obj):
+    pass
+
+
+class page(obj):
+
+    @staticmethod
+    def glue_obj(o, glue):
+        return
+
+
+class tabview(obj):
+    STYLE = _Enum("STYLE")
+    BTNS_POS = _Enum("BTNS_POS")
+
+    def add_tab(self, name):
+        return page(self)
+
+
+class chart_series_t:
+
+    def __init__(self, color, point_cnt):
+        self.color = color
+        self.points = [0] * point_cnt
+        return
+
+
+class chart(obj):
+    """lv_chart of lvgl 6.0
+
+    calls counts the calls into the chart, point_writes the points
+    written, set_next shifts included, and refreshes the invalidations,
+    to compare plotting strategies without a display.
+    """
+
+    def __init__(self, parent=None, copy=None):
+        super().__init__(parent, copy)
+        self.series = []
+        self.point_cnt = 10
+        self.ymin = 0
+        self.ymax = 100
+        self.calls = 0
+        self.point_writes = 0
+        self.refreshes = 0
+        return
+
+    def add_series(self, color):
+        ser = chart_series_t(color, self.point_cnt)
+        self.series.append(ser)
+        return ser
+
+    def clear_serie(self, ser):
+        self.calls += 1
+        ser.points[:] = [0] * self.point_cnt
+        self.refreshes += 1
+
+    def set_point_count(self, n):
+        self.calls += 1
+        for ser in self.series:
+            if n < self.point_cnt:
+                del ser.points[n:]
+            else:
+                ser.points.extend([ser.points[-1] if ser.points else 0] * (n - self.point_cnt))
+        self.point_cnt = n
+        self.refreshes += 1
+
+    def get_point_cnt(self):
+        return self.point_cnt
+
+    def set_range(self, ymin, ymax):
+        self.calls += 1
+        self.ymin = ymin
+        self.ymax = ymax
+        self.refreshes += 1
+
+    def set_next(self, ser, y):
+        self.calls += 1
+        # 6.0 moves every point one to the left
+        del ser.points[0]
+        ser.points.append(y)
+        self.point_writes += self.point_cnt
+        self.refreshes += 1
+
+    def init_points(self, ser, y):
+        self.calls += 1
+        ser.points[:] = [y] * self.point_cnt
+        self.point_writes += self.point_cnt
+        self.refreshes += 1
+
+    def set_points(self, ser, y_array):
+        self.calls += 1
+        ser.points[:] = list(y_array[0:self.point_cnt])
+        self.point_writes += self.point_cnt
+        self.refreshes += 1
+
+    def refresh(self):
+        self.refreshes += 1
+
+
+class style_t(_Any):
+    pass
+
+
+class disp_buf_t(_Any):
+    pass
+
+
+class disp_drv_t(_Any):
+    pass
+
+
+class indev_drv_t(_Any):
+    pass
+
+
+FIT = _Enum("FIT")
+ALIGN = _Enum("ALIGN")
+ANIM = _Enum("ANIM")
+EVENT = _Enum("EVENT")
+LAYOUT = _Enum("LAYOUT")
+INDEV_TYPE = _Enum("INDEV_TYPE")
+
+
+class TASK_PRIO:
+    OFF = 0
+    LOWEST = 1
+    LOW = 2
+    MID = 3
+    HIGH = 4
+    HIGHEST = 5
+
+
+class SYMBOL:
+    WIFI = ""
+    OK = ""
+    CLOSE = ""
+    WARNING = ""
+
+
+font_roboto_16 = object()
+_scr = None
+_tasks = []
+
+
+class task_t:
+
+    def __init__(self, period, prio, user_data):
+        self.period = period
+        self.prio = prio
+        self.user_data = user_data
+        self.cb = None
+        self.last_run = _time.monotonic()
+        return
+
+
+def init():
+    return
+
+
+def color_hex(c):
+    return c
+
+
+def style_copy(dest, src):
+    dest.__dict__.update(src.__dict__)
+
+
+def theme_night_init(hue, font):
+    return _Any()
+
+
+def theme_set_current(th):
+    return
+
+
+def scr_load(scr):
+    global _scr
+    _scr = scr
+
+
+def scr_act():
+    return _scr
+
+
+def disp_buf_init(disp_buf, buf1, buf2, size):
+    return
+
+
+def disp_drv_init(drv):
+    return
+
+
+def disp_drv_register(drv):
+    return _Any()
+
+
+def indev_drv_init(drv):
+    return
+
+
+def indev_drv_register(drv):
+    return _Any()
+
+
+def task_create(cb, period, prio, user_data):
+    task = task_t(period, prio, user_data)
+    task.cb = cb
+    _tasks.append(task)
+    return task
+
+
+def task_set_cb(task, cb):
+    task.cb = cb
+
+
+def task_set_prio(task, prio):
+    task.prio = prio
+
+
+def task_set_period(task, period):
+    task.period = period
+
+
+def task_del(task):
+    _tasks.remove(task)
+
+
+def task_handler():
+    """Run the due tasks, highest priority first"""
+    now = _time.monotonic()
+    for task in sorted(_tasks, key=lambda t: -t.prio):
+        if task.prio == TASK_PRIO.OFF or task.cb is None:
+            continue
+        if (now - task.last_run) * 1000 >= task.period:
+            task.last_run = now
+            task.cb(task)
+    return
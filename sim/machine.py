@@ -0,0 +1,215 @@
+"""machine stand-in
+
+UART ids are connected to emulated devices with attach_uart(), I2C buses
+carry the devices in i2c_devices by address.
+"""
+import threading
+import time as _time
+
+from sim import utime
+
+_uarts = {}
+# address -> device with write(data) and read_into(buf), raising OSError
+# (a NAK) while busy
+i2c_devices = {}
+
+
+def attach_uart(uart_id, device):
+    """Connect UART(uart_id) to device, see sim.amp.AmpEmulator"""
+    _uarts[uart_id] = device
+    return
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+def freq(hz=None):
+    return 240000000
+
+
+def unique_id():
+    return b"\x24\x0a\xc4\x00\x00\x01"
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, pin_id, mode=-1, pull=-1, value=None):
+        self.id = pin_id
+        self._value = 0 if value is None else value
+        return
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = v
+        return
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def __repr__(self):
+        return "Pin(%s)" % self.id
+
+
+class PWM:
+    """Records what the buzzer would play in PWM.log"""
+    log = []
+
+    def __init__(self, pin, freq=0, duty=512):
+        self._pin = pin
+        self._freq = freq
+        PWM.log.append((utime.ticks_ms(), pin.id, freq))
+        return
+
+    def freq(self, f=None):
+        if f is None:
+            return self._freq
+        self._freq = f
+        PWM.log.append((utime.ticks_ms(), self._pin.id, f))
+
+    def duty(self, d=None):
+        return 512
+
+    def deinit(self):
+        PWM.log.append((utime.ticks_ms(), self._pin.id, 0))
+
+
+class UART:
+    """UART with the timing of the device attached with attach_uart()
+
+    Reads never block, like a UART initialised with timeout=0.
+    """
+
+    def __init__(self, uart_id, baudrate=115200, **kwargs):
+        self._id = uart_id
+        self._dev = _uarts.get(uart_id)
+        self._lock = threading.Lock()
+        self.init(baudrate, **kwargs)
+        return
+
+    def init(self, baudrate=115200, bits=8, parity=None, stop=1, **kwargs):
+        self._baudrate = baudrate
+        if self._dev is not None:
+            self._dev.set_baudrate(baudrate)
+        return
+
+    def deinit(self):
+        return
+
+    def write(self, buf):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        if self._dev is not None:
+            with self._lock:
+                self._dev.receive(bytes(buf))
+        return len(buf)
+
+    def any(self):
+        if self._dev is None:
+            return 0
+        with self._lock:
+            return self._dev.available()
+
+    def read(self, nbytes=None):
+        if self._dev is None:
+            return None
+        with self._lock:
+            n = self._dev.available()
+            if nbytes is not None:
+                n = min(n, nbytes)
+            if n == 0:
+                return None
+            return self._dev.take(n)
+
+    def readinto(self, buf, nbytes=None):
+        if nbytes is None:
+            nbytes = len(buf)
+        data = self.read(nbytes)
+        if not data:
+            return None
+        mv = memoryview(buf).cast("B")
+        mv[0:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        if self._dev is None:
+            return None
+        with self._lock:
+            n = self._dev.available()
+            if n == 0:
+                return None
+            data = self._dev.peek(n)
+            end = data.find(b"\n")
+            if end >= 0:
+                n = end + 1
+            return self._dev.take(n)
+
+    def _sim_wait_s(self):
+        """Seconds until the next byte arrives, None if none is coming"""
+        if self._dev is None:
+            return None
+        with self._lock:
+            return self._dev.next_arrival_s()
+
+
+class I2C:
+
+    def __init__(self, bus_id=-1, scl=None, sda=None, freq=400000):
+        return
+
+    def scan(self):
+        return sorted(i2c_devices)
+
+    def _dev(self, addr):
+        try:
+            return i2c_devices[addr]
+        except KeyError:
+            raise OSError(19)
+
+    def writeto(self, addr, buf, stop=True):
+        self._dev(addr).write(bytes(buf))
+        return len(buf)
+
+    def readfrom_into(self, addr, buf, stop=True):
+        self._dev(addr).read_into(buf)
+        return
+
+    def readfrom(self, addr, nbytes, stop=True):
+        buf = bytearray(nbytes)
+        self.readfrom_into(addr, buf)
+        return bytes(buf)
+
+
+class SDCard:
+    """The card is a directory under the simulation root, see uos.mount"""
+
+    def __init__(self, slot=1, **kwargs):
+        self.slot = slot
+        return
+
+
+class RTC:
+
+    def datetime(self, dt=None):
+        """(year, month, day, weekday, hours, minutes, seconds, subseconds)"""
+        if dt is None:
+            t = utime.localtime()
+            return (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
+        secs = utime.mktime((dt[0], dt[1], dt[2], dt[4], dt[5], dt[6], 0, 0))
+        utime.rtc_offset += secs - utime.time()
+        return
+
+    def init(self, dt):
+        self.datetime(dt)
+
+
+def idle():
+    _time.sleep(0.001)
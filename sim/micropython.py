@@ -0,0 +1,33 @@
+"""micropython stand-in, the code emitters are plain Python here"""
+
+
+def const(expr):
+    return expr
+
+
+def native(f):
+    return f
+
+
+def viper(f):
+    return f
+
+
+def opt_level(level=None):
+    return 0
+
+
+def alloc_emergency_exception_buf(size):
+    return
+
+
+def mem_info(verbose=False):
+    print("mem: not available in the simulation")
+
+
+def qstr_info(verbose=False):
+    return
+
+
+def schedule(func, arg):
+    func(arg)
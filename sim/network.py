@@ -0,0 +1,72 @@
+"""network stand-in
+
+The access point is scripted through the module globals: ap_up says if
+it can be reached, connect_delay_s how long association takes.
+"""
+from sim import utime
+
+STA_IF = 0
+AP_IF = 1
+STAT_IDLE = 1000
+STAT_CONNECTING = 1001
+STAT_GOT_IP = 1010
+STAT_NO_AP_FOUND = 201
+
+ap_up = True
+connect_delay_s = 0.5
+ssid = None
+
+
+class WLAN:
+    _ifaces = {}
+
+    def __new__(cls, interface_id=STA_IF):
+        # Like the firmware, one object per interface
+        if interface_id not in cls._ifaces:
+            obj = object.__new__(cls)
+            obj._active = False
+            obj._connect_ms = None
+            obj._ssid = None
+            cls._ifaces[interface_id] = obj
+        return cls._ifaces[interface_id]
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        self._active = bool(is_active)
+        if not self._active:
+            self._connect_ms = None
+        return
+
+    def connect(self, ssid=None, password=None, **kwargs):
+        if not self._active:
+            raise OSError("STA must be active")
+        self._ssid = ssid
+        self._connect_ms = utime.ticks_ms()
+        return
+
+    def disconnect(self):
+        self._connect_ms = None
+        return
+
+    def status(self, param=None):
+        if self._connect_ms is None:
+            return STAT_IDLE
+        if not ap_up or (ssid is not None and self._ssid != ssid):
+            return STAT_NO_AP_FOUND
+        if utime.ticks_diff(utime.ticks_ms(), self._connect_ms) < connect_delay_s * 1000:
+            return STAT_CONNECTING
+        return STAT_GOT_IP
+
+    def isconnected(self):
+        return self._active and self.status() == STAT_GOT_IP
+
+    def ifconfig(self, config=None):
+        if self.isconnected():
+            return ("192.168.0.50", "255.255.255.0", "192.168.0.1", "192.168.0.1")
+        return ("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0")
+
+    def config(self, *args, **kwargs):
+        if args == ("mac",):
+            return b"\x24\x0a\xc4\x00\x00\x01"
+        return None
@@ -0,0 +1,111 @@
+"""Stand-in for the data server the uploader posts to
+
+    server = UploadServer()
+    server.start()
+    up = uploader.Uploader(server.host, server.port, "/sd/upload.q", online)
+    ...
+    server.records["/th/"]
+    server.stop()
+
+Speaks HTTP/1.1 with keep-alive on a free local port and keeps every
+JSON record it is sent, per path. Set status to answer with another code
+(e.g. 503) and down to refuse connections, to script outages.
+"""
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        owner = self.server.owner
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        owner.requests += 1
+        status = owner.status
+        if status // 100 == 2:
+            try:
+                batch = json.loads(body)
+            except ValueError:
+                status = 400
+            else:
+                with owner.lock:
+                    owner.records.setdefault(self.path, []).extend(batch)
+                    owner.batches.append((self.path, len(batch)))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+        return
+
+    def log_message(self, fmt, *args):
+        return
+
+
+class UploadServer:
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.status = 200
+        self.records = {}
+        self.batches = []
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+        self._socks = []
+        return
+
+    @property
+    def down(self):
+        return self._httpd is None
+
+    @down.setter
+    def down(self, down):
+        if down:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        owner = self
+
+        class _Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def process_request(self, request, client_address):
+                owner.connections += 1
+                owner._socks.append(request)
+                return super().process_request(request, client_address)
+
+            def handle_error(self, request, client_address):
+                # Connections dropped by stop() or the client
+                return
+        self._httpd = _Server((self.host, self.port), _Handler)
+        self._httpd.owner = self
+        # Keep the port over restarts
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return
+
+    def stop(self):
+        """Stop serving, open connections are dropped too"""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        for sock in self._socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._socks = []
+        return
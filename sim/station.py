@@ -0,0 +1,52 @@
+"""Measuring session driven the way the GUI drives it"""
+import _thread
+
+import utime
+
+# As the GUI task
+WAIT_PANEL_PERIOD = 50
+
+
+def run_session(laser, panels, material="OSB", thickness="12", fmt=None):
+    """Measure panels panels in a new session, returns one dict per panel
+
+    Like gui_ctrl, the acquisition thread measures and process() is
+    called every WAIT_PANEL_PERIOD ms until the panel is done.
+    """
+    import laser_ctrl
+    if fmt is None:
+        fmt = laser_ctrl.FMT_BIN
+    lock = _thread.allocate_lock()
+    laser.start_worker()
+    laser.start_session(material, thickness, fmt)
+    filename = laser._session.get_filename()
+    results = []
+    try:
+        for _ in range(0, panels):
+            # The operator waits for the last panel to clear the stacks
+            # before pressing New Panel
+            while max(laser.get_phrase_pvs()) > 0:
+                utime.sleep_ms(20)
+            panel = laser._session.new_panel()
+            laser.measure(panel, lock)
+            while not laser.process():
+                utime.sleep_ms(WAIT_PANEL_PERIOD)
+            rate, mean_us, std_us, max_us = panel.sample_stats()
+            results.append({
+                "id": laser._session.count,
+                "samples": panel._in,
+                "good": panel.good,
+                "err": None if panel.err is None else str(panel.err),
+                "diff_um": list(panel.diff),
+                "std_um": list(panel.std),
+                "flat_um": list(panel.flat),
+                "slope_um": list(panel.slope),
+                "worst": list(panel.worst),
+                "rate_hz": rate,
+                "period_mean_us": mean_us,
+                "period_std_us": std_us,
+                "period_max_us": max_us,
+            })
+    finally:
+        laser.end_session()
+    return filename, results
@@ -0,0 +1,22 @@
+"""ujson stand-in
+
+Like the firmware, arrays are written with their repr, which is not
+JSON; panel_format.text_list reads it back.
+"""
+import json
+from array import array
+
+loads = json.loads
+dumps = json.dumps
+
+
+def load(stream):
+    return json.loads(stream.read())
+
+
+def dump(obj, stream):
+    if isinstance(obj, array):
+        stream.write("array('%s', %s)" % (obj.typecode, json.dumps(obj.tolist())))
+    else:
+        stream.write(json.dumps(obj, separators=(", ", ": ")))
+    return
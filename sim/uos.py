@@ -0,0 +1,58 @@
+"""uos stand-in, device paths are mapped under sim.root"""
+import os
+
+import sim
+
+# Mount points of the device file system, e.g. "/sd"
+mounts = {}
+
+
+def mount(dev, path):
+    mounts[path] = dev
+    os.makedirs(sim.device_path(path + "/"), exist_ok=True)
+    return
+
+
+def umount(path):
+    mounts.pop(path, None)
+    return
+
+
+def listdir(path="/"):
+    return sorted(os.listdir(sim.device_path(path) if path != "/" else sim.root))
+
+
+def ilistdir(path="/"):
+    for name in listdir(path):
+        full = os.path.join(sim.device_path(path) if path != "/" else sim.root, name)
+        yield (name, 0x4000 if os.path.isdir(full) else 0x8000, 0)
+
+
+def remove(path):
+    os.remove(sim.device_path(path))
+
+
+def rename(old, new):
+    os.rename(sim.device_path(old), sim.device_path(new))
+
+
+def mkdir(path):
+    os.mkdir(sim.device_path(path))
+
+
+def stat(path):
+    return tuple(os.stat(sim.device_path(path)))[0:10]
+
+
+def statvfs(path):
+    st = os.statvfs(sim.device_path(path) if path != "/" else sim.root)
+    return (st.f_bsize, st.f_frsize, st.f_blocks, st.f_bfree, st.f_bavail,
+            st.f_files, st.f_ffree, st.f_favail, st.f_flag, st.f_namemax)
+
+
+def uname():
+    return ("esp32", "esp32", "sim", "sim", "ESP32 module (simulated)")
+
+
+def urandom(n):
+    return os.urandom(n)
@@ -0,0 +1,98 @@
+"""python3 -m sim.uploads
+
+Checks the uploader of LaserMCU against sim.server: records are sent
+by flush() only, queued on the SD card while the WiFi or the server is
+down, and replayed in order once they are back. Exits 1 if a check
+fails.
+"""
+import sys
+
+import sim
+
+RECORDS = 40
+
+
+def _wait_wifi(mcu, up=True, timeout_s=5):
+    import utime
+    import laser_mcu
+    start = utime.ticks_ms()
+    while (mcu.poll_wifi() == laser_mcu.WIFI_UP) != up:
+        if utime.ticks_diff(utime.ticks_ms(), start) > timeout_s * 1000:
+            raise AssertionError("WiFi not %s" % ("up" if up else "down"))
+        utime.sleep_ms(20)
+    return
+
+
+def _th(i):
+    return '{"i":%d}' % i
+
+
+def check_uploads():
+    """Send, go offline, queue and replay, returns the records received"""
+    from sim import network
+    import laser_mcu
+    server = sim.upload_server
+    mcu = laser_mcu.LaserMCU()
+    mcu.mount_sd()
+    up = mcu.uploader
+    _wait_wifi(mcu)
+
+    for i in range(0, RECORDS):
+        up.add("/th/", _th(i))
+    # add() runs during a measurement, only flush() may connect
+    assert server.connections == 0, "add() sent records"
+    assert up.flush(), "online flush left %s" % (up.pending(),)
+    assert len(server.records.get("/th/", [])) == RECORDS, "records not sent"
+    print("online: %d records in %d requests on %d connection(s)"
+          % (up.sent, server.requests, server.connections))
+
+    # WiFi lost, records go to the queue file
+    network.ap_up = False
+    _wait_wifi(mcu, False)
+    for i in range(RECORDS, 2 * RECORDS):
+        up.add("/th/", _th(i))
+    assert not up.flush(), "offline flush reported done"
+    memory, queued = up.pending()
+    assert memory == 0 and queued > 0, "offline records not queued"
+    print("offline: %d bytes queued" % queued)
+
+    # WiFi back but the server down, the queue is kept
+    network.ap_up = True
+    _wait_wifi(mcu)
+    server.down = True
+    up.add("/panel/", '{"id":1}')
+    assert not up.flush(), "flush with the server down reported done"
+    assert up.failures == 1, "%d failures" % up.failures
+    print("server down: %d bytes queued" % up.pending()[1])
+
+    # Server back, skip the retry wait and replay
+    server.down = False
+    up._t_fail = None
+    flushes = 0
+    while not up.flush():
+        flushes += 1
+        assert flushes < 20, "queue not replayed"
+    ids = [r["i"] for r in server.records["/th/"]]
+    assert ids == list(range(0, 2 * RECORDS)), "records out of order or lost"
+    assert len(server.records["/panel/"]) == 1, "panel record lost"
+    assert up.pending() == (0, 0), "left %s" % (up.pending(),)
+    print("replayed in %d flushes, %d records received in order"
+          % (flushes + 1, len(ids) + 1))
+    mcu.shutdown()
+    return len(ids) + 1
+
+
+def main(argv):
+    sim.install(root_dir=argv[0] if argv else None)
+    try:
+        check_uploads()
+    except AssertionError as err:
+        print("FAILED:", err)
+        return 1
+    finally:
+        sim.uninstall()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+"""uselect stand-in
+
+poll works on simulated UARTs (anything with _sim_wait_s) and on real
+host sockets and files. Like MicroPython, events name the registered
+object, not its file descriptor.
+"""
+import select
+import time as _time
+
+POLLIN = select.POLLIN
+POLLOUT = select.POLLOUT
+POLLERR = select.POLLERR
+POLLHUP = select.POLLHUP
+
+
+class poll:
+
+    def __init__(self):
+        self._objs = {}
+        return
+
+    def register(self, obj, eventmask=POLLIN | POLLOUT):
+        self._objs[id(obj)] = (obj, eventmask)
+        return
+
+    def unregister(self, obj):
+        self._objs.pop(id(obj), None)
+        return
+
+    def modify(self, obj, eventmask):
+        if id(obj) not in self._objs:
+            raise OSError(2)
+        self._objs[id(obj)] = (obj, eventmask)
+        return
+
+    def _ready(self):
+        events = []
+        host = select.poll()
+        fds = {}
+        for obj, mask in self._objs.values():
+            if hasattr(obj, "_sim_wait_s"):
+                ev = 0
+                if mask & POLLIN and obj.any():
+                    ev |= POLLIN
+                if mask & POLLOUT:
+                    ev |= POLLOUT
+                if ev:
+                    events.append((obj, ev))
+            else:
+                fds[obj.fileno()] = obj
+                host.register(obj, mask)
+        if fds:
+            for fd, ev in host.poll(0):
+                events.append((fds[fd], ev))
+        return events
+
+    def _wait_s(self, limit):
+        # Sleep until a simulated byte is due, host objects are polled
+        # every millisecond
+        wait = limit
+        for obj, mask in self._objs.values():
+            if hasattr(obj, "_sim_wait_s"):
+                w = obj._sim_wait_s()
+                if w is not None:
+                    wait = min(wait, w)
+            else:
+                wait = min(wait, 0.001)
+        return max(wait, 0)
+
+    def poll(self, timeout=-1):
+        deadline = None if timeout < 0 else _time.monotonic() + timeout / 1000
+        while True:
+            events = self._ready()
+            if events:
+                return events
+            if deadline is None:
+                limit = 0.1
+            else:
+                limit = deadline - _time.monotonic()
+                if limit <= 0:
+                    return []
+            _time.sleep(self._wait_s(limit) + 0.00005)
+
+    def ipoll(self, timeout=-1, flags=0):
+        return iter(self.poll(timeout))
@@ -0,0 +1,22 @@
+"""usocket stand-in
+
+The simulated LAN has one host, sim.server.UploadServer (set as server
+by sim.install()). Every address but the loopback one resolves to it,
+whatever the port, so the MCU code never reaches the host's network.
+With no server the address does not resolve.
+"""
+import errno
+import socket as _socket
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+
+server = None
+
+_LOOPBACK = ("127.0.0.1", "localhost")
+
+
+def getaddrinfo(host, port, *args):
+    if host in _LOOPBACK:
+        return _socket.getaddrinfo(host, port, *args)
+    if server is None:
+        raise OSError(errno.EHOSTUNREACH, "No route to host")
+    return _socket.getaddrinfo(server.host, server.port, *args)
@@ -0,0 +1,21 @@
+"""_thread stand-in
+
+MicroPython takes the arguments of start_new_thread as a list or a
+tuple, CPython only as a tuple.
+"""
+import _thread
+
+allocate_lock = _thread.allocate_lock
+get_ident = _thread.get_ident
+exit = _thread.exit
+LockType = _thread.LockType
+
+
+def start_new_thread(function, args, kwargs=None):
+    if kwargs is None:
+        return _thread.start_new_thread(function, tuple(args))
+    return _thread.start_new_thread(function, tuple(args), kwargs)
+
+
+def stack_size(size=None):
+    return 0 if size is None else _thread.stack_size()
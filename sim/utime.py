@@ -0,0 +1,69 @@
+"""utime stand-in on the host clock
+
+Ticks wrap like on the ESP32 (TICKS_PERIOD), time() and localtime() use
+the MicroPython 2000-01-01 epoch and follow machine.RTC().
+"""
+import time as _time
+
+TICKS_PERIOD = 1 << 30
+_TICKS_MAX = TICKS_PERIOD - 1
+_TICKS_HALF = TICKS_PERIOD // 2
+EPOCH_OFFSET = 946684800
+
+# Seconds added to the host clock by machine.RTC().datetime()
+rtc_offset = 0
+_t0 = _time.monotonic()
+
+
+def _now():
+    return _time.monotonic() - _t0
+
+
+def ticks_ms():
+    return int(_now() * 1000) & _TICKS_MAX
+
+
+def ticks_us():
+    return int(_now() * 1000000) & _TICKS_MAX
+
+
+def ticks_cpu():
+    return ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+
+def time():
+    return int(_time.time() + rtc_offset) - EPOCH_OFFSET
+
+
+def localtime(secs=None):
+    if secs is None:
+        secs = time()
+    return tuple(_time.gmtime(secs + EPOCH_OFFSET)[0:8])
+
+
+gmtime = localtime
+
+
+def mktime(t):
+    import calendar
+    return calendar.timegm(tuple(t[0:6]) + (0, 0, 0)) - EPOCH_OFFSET
+
+
+def sleep(secs):
+    _time.sleep(secs)
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
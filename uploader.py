@@ -0,0 +1,291 @@
+"""uploader.py
+
+Batched upload of JSON records to the data server
+
+Records are sent as one JSON array per POST over a keep-alive HTTP/1.1
+connection. While offline, or after a failed request, they are appended
+to a queue file on the SD card, one "<path>\\t<json>" line each, which is
+replayed in order once the server can be reached again. Delivery is at
+least once: a batch may be sent again after a reset during a replay.
+"""
+import utime
+import uos
+import usocket
+import uselect
+
+try:
+    from uerrno import ETIMEDOUT
+except ImportError:
+    from errno import ETIMEDOUT
+
+from micropython import const
+
+# Records per POST
+UPLOAD_BATCH = const(16)
+# Batches replayed from the queue per flush(), bounds the time taken from
+# the GUI task
+UPLOAD_REPLAY_BATCHES = const(4)
+# Reply deadline in ms
+UPLOAD_TIMEOUT = const(2000)
+# Wait after a failed request before the next attempt, in ms
+UPLOAD_RETRY = const(60000)
+
+
+class Uploader:
+    """Keep-alive HTTP client with an SD backed queue
+
+    online is called to check the link (e.g. LaserMCU.is_connected)
+    before any connection is attempted. Call add() for every record and
+    flush() periodically, only flush() does network I/O and neither
+    raises on network errors.
+    """
+
+    def __init__(self, host, port, queue_file, online):
+        self._host = host
+        self._port = port
+        self._queue_file = queue_file
+        self._online = online
+        self._sock = None
+        self._rf = None
+        self._poll = uselect.poll()
+        self._pending = []
+        # Replayed part of the queue file
+        self._q_pos = 0
+        # Unknown until the first flush, the SD card may not be up yet
+        self._queued = None
+        self._t_fail = None
+        self.sent = 0
+        self.requests = 0
+        self.connects = 0
+        self.failures = 0
+        return
+
+    def add(self, path, record):
+        """Queue the JSON string record for path, sent by the next flush()
+
+        Never touches the network, it is called while a panel is being
+        measured. A full batch is moved to the queue file instead.
+        """
+        self._pending.append((path, record))
+        if len(self._pending) >= UPLOAD_BATCH:
+            self._spill()
+        return
+
+    def pending(self):
+        """Records not sent yet, in memory and in the queue file"""
+        return len(self._pending), self._queue_size() - self._q_pos
+
+    def flush(self):
+        """Replay the queue and send the pending records
+
+        Records that can not be sent now are appended to the queue file.
+        Returns True if nothing is left to send.
+        """
+        if self._queued is None:
+            self._queued = self._queue_size() > 0
+        if self._can_send():
+            try:
+                if self._queued:
+                    self._replay()
+                if not self._queued:
+                    self._send_pending()
+            except OSError as err:
+                print("Upload: {0}".format(err))
+                self._fail()
+        if self._pending:
+            self._spill()
+        return not self._pending and not self._queued
+
+    def close(self):
+        if self._sock is not None:
+            self._poll.unregister(self._sock)
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+            self._rf = None
+        return
+
+    def _can_send(self):
+        if self._t_fail is not None:
+            if utime.ticks_diff(utime.ticks_ms(), self._t_fail) < UPLOAD_RETRY:
+                return False
+            self._t_fail = None
+        return self._online()
+
+    def _fail(self):
+        self.failures += 1
+        self._t_fail = utime.ticks_ms()
+        self.close()
+        return
+
+    def _send_pending(self):
+        pending = self._pending
+        while pending:
+            # One path per batch
+            path = pending[0][0]
+            n = 1
+            while n < len(pending) and n < UPLOAD_BATCH and pending[n][0] == path:
+                n += 1
+            self._post(path, [r for p, r in pending[0:n]])
+            del pending[0:n]
+        return
+
+    def _replay(self):
+        f = open(self._queue_file, "rb")
+        try:
+            f.seek(self._q_pos)
+            for _ in range(0, UPLOAD_REPLAY_BATCHES):
+                path = None
+                records = []
+                pos = self._q_pos
+                while len(records) < UPLOAD_BATCH:
+                    line = f.readline()
+                    if not line:
+                        break
+                    tab = line.find(b"\t")
+                    if tab < 0 or line[-1] != 10:
+                        # Torn line from a reset while spilling
+                        pos += len(line)
+                        continue
+                    p = line[0:tab].decode("utf8")
+                    if path is not None and p != path:
+                        break
+                    path = p
+                    records.append(line[tab + 1:-1].decode("utf8"))
+                    pos += len(line)
+                if not records:
+                    break
+                self._post(path, records)
+                self._q_pos = pos
+                # A line of the next batch may have been read
+                f.seek(pos)
+        finally:
+            f.close()
+        if self._q_pos >= self._queue_size():
+            uos.remove(self._queue_file)
+            self._q_pos = 0
+            self._queued = False
+        return
+
+    def _spill(self):
+        try:
+            f = open(self._queue_file, "a")
+            try:
+                for path, record in self._pending:
+                    f.write(path)
+                    f.write("\t")
+                    f.write(record)
+                    f.write("\n")
+            finally:
+                f.close()
+        except OSError as err:
+            print("Upload queue: {0}".format(err))
+            # Keep them in memory, bounded
+            del self._pending[0:-UPLOAD_BATCH]
+            return
+        del self._pending[:]
+        self._queued = True
+        return
+
+    def _queue_size(self):
+        try:
+            return uos.stat(self._queue_file)[6]
+        except OSError:
+            return 0
+
+    def _connect(self):
+        addr = usocket.getaddrinfo(self._host, self._port)[0][-1]
+        s = usocket.socket()
+        try:
+            s.settimeout(UPLOAD_TIMEOUT / 1000)
+            s.connect(addr)
+        except OSError:
+            s.close()
+            raise
+        self._sock = s
+        self._rf = s.makefile("rb")
+        self._poll.register(s, uselect.POLLIN)
+        self.connects += 1
+        return
+
+    def _post(self, path, records):
+        """POST records as a JSON array, raises OSError on failure"""
+        body = bytes("[" + ",".join(records) + "]", "utf8")
+        head = bytes(
+            (
+                "POST %s HTTP/1.1\r\n"
+                "Host: %s\r\n"
+                "Connection: keep-alive\r\n"
+                "Content-Type: application/json\r\n"
+                "Content-Length: %d\r\n\r\n"
+            )
+            % (path, self._host, len(body)),
+            "utf8"
+        )
+        for attempt in range(0, 2):
+            fresh = self._sock is None
+            if fresh:
+                self._connect()
+            try:
+                # One segment for small batches
+                self._sock.sendall(head + body)
+                status, keep = self._response()
+                break
+            except OSError:
+                self.close()
+                # The server may have closed an idle connection
+                if fresh or attempt:
+                    raise
+        if not keep:
+            self.close()
+        if status // 100 == 4:
+            # Sending it again would not help, drop the batch so it does
+            # not hold up the queue
+            print("Upload: HTTP %d, %d records dropped" % (status, len(records)))
+            return
+        if status // 100 != 2:
+            raise OSError("HTTP %d" % status)
+        self.requests += 1
+        self.sent += len(records)
+        return
+
+    def _response(self):
+        """Status code and keep-alive of the reply, the body is skipped"""
+        for obj, ev in self._poll.ipoll(UPLOAD_TIMEOUT):
+            if ev & (uselect.POLLERR | uselect.POLLHUP) and not ev & uselect.POLLIN:
+                raise OSError("Connection lost")
+            break
+        else:
+            raise OSError(ETIMEDOUT)
+        rf = self._rf
+        line = rf.readline()
+        if not line:
+            raise OSError("Connection closed")
+        parts = line.split()
+        try:
+            status = int(parts[1])
+        except (ValueError, IndexError):
+            raise OSError("Bad status line")
+        keep = parts[0] == b"HTTP/1.1"
+        length = 0
+        while True:
+            line = rf.readline()
+            if not line or line == b"\r\n":
+                break
+            colon = line.find(b":")
+            name = line[0:colon].strip().lower()
+            if name == b"content-length":
+                try:
+                    length = int(line[colon + 1:])
+                except ValueError:
+                    raise OSError("Bad Content-Length")
+            elif name == b"connection":
+                keep = line[colon + 1:].strip().lower() == b"keep-alive"
+        while length > 0:
+            chunk = rf.read(min(length, 64))
+            if not chunk:
+                raise OSError("Connection closed")
+            length -= len(chunk)
+        return status, keep
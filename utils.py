@@ -3,8 +3,38 @@
 helper functions
 """
 import utime
+from array import array
 
 from machine import reset
+from micropython import const
+
+# Profiler slots and latency buckets
+PROF_MAX_FUNCS = const(32)
+PROF_BUCKETS = const(8)
+# Upper bucket bounds in us, the last bucket takes the rest
+_PROF_BOUNDS = (100, 300, 1000, 3000, 10000, 30000, 100000)
+# Profiler on from boot, prof_enable() switches it later
+PROFILE = False
+_prof_on = PROFILE
+_prof_names = []
+_prof_count = array('I', [0] * PROF_MAX_FUNCS)
+# Total time in ms and the us below a ms, so no value leaves the small
+# int range
+_prof_total_ms = array('I', [0] * PROF_MAX_FUNCS)
+_prof_total_us = array('H', [0] * PROF_MAX_FUNCS)
+_prof_min = array('I', [0] * PROF_MAX_FUNCS)
+_prof_max = array('I', [0] * PROF_MAX_FUNCS)
+_prof_hist = array('I', [0] * (PROF_MAX_FUNCS * PROF_BUCKETS))
+# Every SensorCache, for prof_dump
+_caches = []
+# Boot timeline, see boot_mark()
+BOOT_MAX_MARKS = const(24)
+_boot_names = []
+_boot_ticks = array('I', [0] * BOOT_MAX_MARKS)
+
+
+def _func_name(f):
+    return str(f).split(' ')[1]
 
 
 def timed_function(f, *args, **kwargs):
@@ -12,7 +42,7 @@ def timed_function(f, *args, **kwargs):
 
     Time a function using @timed_function decorator
     """
-    myname = str(f).split(' ')[1]
+    myname = _func_name(f)
     def new_func(*args, **kwargs):
         t = utime.ticks_us()
         result = f(*args, **kwargs)
@@ -21,3 +51,267 @@ def timed_function(f, *args, **kwargs):
         return result
     return new_func
 
+
+def prof_register(name):
+    """Slot of name in the profiler, registered on first use"""
+    for i in range(0, len(_prof_names)):
+        if _prof_names[i] == name:
+            return i
+    if len(_prof_names) == PROF_MAX_FUNCS:
+        raise IndexError("Profiler full")
+    _prof_names.append(name)
+    return len(_prof_names) - 1
+
+
+def prof_add(slot, t):
+    """Account the time since ticks_us() t to slot
+
+    Only array updates, nothing is allocated. For hot loops:
+
+        t = utime.ticks_us()
+        ...
+        prof_add(SLOT, t)
+
+    The updates are not locked, a slot must only be written by one
+    thread at a time. The acquisition slots are written by the thread
+    holding the laser lock, @profiled functions by whoever calls them.
+    """
+    if not _prof_on:
+        return
+    delta = utime.ticks_diff(utime.ticks_us(), t)
+    n = _prof_count[slot]
+    _prof_count[slot] = n + 1
+    us = _prof_total_us[slot] + delta
+    if us >= 1000:
+        _prof_total_ms[slot] += us // 1000
+        us %= 1000
+    _prof_total_us[slot] = us
+    if n == 0 or delta < _prof_min[slot]:
+        _prof_min[slot] = delta
+    if delta > _prof_max[slot]:
+        _prof_max[slot] = delta
+    b = 0
+    for bound in _PROF_BOUNDS:
+        if delta < bound:
+            break
+        b += 1
+    _prof_hist[slot * PROF_BUCKETS + b] += 1
+    return
+
+
+def profiled(f):
+    """Account every call of f to the profiler
+
+    Like timed_function, but silent. Calls cost a ticks_us() pair while
+    the profiler is on and a check of it while off. The wrapper takes
+    *args, which MicroPython allocates on every call, so use profiled1
+    or profiled2 where the arity is fixed and time the inside of hot
+    loops with prof_add.
+    """
+    slot = prof_register(_func_name(f))
+    def new_func(*args, **kwargs):
+        if not _prof_on:
+            return f(*args, **kwargs)
+        t = utime.ticks_us()
+        result = f(*args, **kwargs)
+        prof_add(slot, t)
+        return result
+    return new_func
+
+
+def profiled1(f):
+    """profiled for f(a), e.g. methods without arguments, allocates nothing"""
+    slot = prof_register(_func_name(f))
+    def new_func(a):
+        if not _prof_on:
+            return f(a)
+        t = utime.ticks_us()
+        result = f(a)
+        prof_add(slot, t)
+        return result
+    return new_func
+
+
+def profiled2(f):
+    """profiled for f(a, b), e.g. LVGL task callbacks, allocates nothing"""
+    slot = prof_register(_func_name(f))
+    def new_func(a, b):
+        if not _prof_on:
+            return f(a, b)
+        t = utime.ticks_us()
+        result = f(a, b)
+        prof_add(slot, t)
+        return result
+    return new_func
+
+
+def prof_enable(on=True):
+    """Switch the profiler on or off, the statistics are kept"""
+    global _prof_on
+    _prof_on = on
+    return
+
+
+def prof_enabled():
+    return _prof_on
+
+
+def prof_reset():
+    for i in range(0, PROF_MAX_FUNCS):
+        _prof_count[i] = 0
+        _prof_total_ms[i] = 0
+        _prof_total_us[i] = 0
+        _prof_min[i] = 0
+        _prof_max[i] = 0
+    for i in range(0, PROF_MAX_FUNCS * PROF_BUCKETS):
+        _prof_hist[i] = 0
+    return
+
+
+def prof_stats(slot):
+    """(name, count, total ms, min us, max us, histogram list) of slot"""
+    total = _prof_total_ms[slot] + _prof_total_us[slot] / 1000
+    hist = list(_prof_hist[slot * PROF_BUCKETS:(slot + 1) * PROF_BUCKETS])
+    return (_prof_names[slot], _prof_count[slot], total, _prof_min[slot],
+            _prof_max[slot], hist)
+
+
+def prof_dump(file=None):
+    """Print the profile summary
+
+    file is an open file, a path to append to (e.g. on the SD card), or
+    None for the serial console. Functions never called are left out.
+    """
+    if isinstance(file, str):
+        f = open(file, "a")
+        try:
+            prof_dump(f)
+        finally:
+            f.close()
+        return
+    dt = utime.localtime()
+    print("Profile %04d-%02d-%02d %02d:%02d:%02d" % dt[0:6], file=file)
+    print("%-24s %8s %10s %8s %8s %8s  histogram <%s us, more"
+          % ("function", "count", "total ms", "mean us", "min us", "max us",
+             "/".join([str(b) for b in _PROF_BOUNDS])), file=file)
+    for i in range(0, len(_prof_names)):
+        name, count, total, t_min, t_max, hist = prof_stats(i)
+        if count == 0:
+            continue
+        print("%-24s %8d %10.1f %8.1f %8d %8d  %s"
+              % (name, count, total, total * 1000 / count, t_min, t_max,
+                 "/".join([str(h) for h in hist])), file=file)
+    for cache in _caches:
+        if cache.hits or cache.misses:
+            print("%-24s %s" % (cache.name, cache), file=file)
+    return
+
+
+def boot_mark(name):
+    """Record that boot phase name ended now
+
+    ticks_ms() counts from reset, so the first mark also tells the time
+    taken by the firmware, boot.py and the imports. Marks past
+    BOOT_MAX_MARKS are ignored.
+    """
+    n = len(_boot_names)
+    if n == BOOT_MAX_MARKS:
+        return
+    _boot_ticks[n] = utime.ticks_ms()
+    _boot_names.append(name)
+    return
+
+
+def boot_timeline():
+    """[(phase, ms from reset to its end, ms it took)] in order"""
+    timeline = []
+    last = 0
+    for i in range(0, len(_boot_names)):
+        t = _boot_ticks[i]
+        timeline.append((_boot_names[i], t, utime.ticks_diff(t, last) if i else t))
+        last = t
+    return timeline
+
+
+def boot_dump(file=None):
+    """Print the boot timeline, file as for prof_dump"""
+    if isinstance(file, str):
+        f = open(file, "a")
+        try:
+            boot_dump(f)
+        finally:
+            f.close()
+        return
+    dt = utime.localtime()
+    print("Boot %04d-%02d-%02d %02d:%02d:%02d" % dt[0:6], file=file)
+    print("%-24s %8s %8s" % ("phase", "at ms", "took ms"), file=file)
+    for name, t, took in boot_timeline():
+        print("%-24s %8d %8d" % (name, t, took), file=file)
+    return
+
+
+class SensorCache:
+    """Latest reading of a sensor and the ticks_ms() it was taken at
+
+    get() returns the cached value while it is at most max_age_ms old
+    and calls read() for a new one otherwise, counting hits and misses
+    so prof_dump shows how many bus reads were saved. Readings taken
+    elsewhere, e.g. by a non-blocking poll, are stored with put().
+    """
+
+    def __init__(self, name, read, max_age_ms):
+        self.name = name
+        self._read = read
+        self.max_age_ms = max_age_ms
+        self.value = None
+        self.ticks = 0
+        self.hits = 0
+        self.misses = 0
+        _caches.append(self)
+        return
+
+    def put(self, value):
+        self.value = value
+        self.ticks = utime.ticks_ms()
+        return
+
+    def age_ms(self):
+        """Age of the value in ms, None if there is none"""
+        if self.value is None:
+            return None
+        return utime.ticks_diff(utime.ticks_ms(), self.ticks)
+
+    def fresh(self, max_age_ms=None):
+        """True if the value is at most max_age_ms old, nothing is counted"""
+        if max_age_ms is None:
+            max_age_ms = self.max_age_ms
+        age = self.age_ms()
+        return age is not None and age <= max_age_ms
+
+    def get(self, max_age_ms=None):
+        """The cached value, or a new reading if it is too old
+
+        max_age_ms overrides the default for consumers with other needs.
+        Exceptions of read() are passed on and the old value is kept.
+        """
+        if self.fresh(max_age_ms):
+            self.hits += 1
+            return self.value
+        self.misses += 1
+        value = self._read()
+        self.put(value)
+        return value
+
+    def invalidate(self):
+        self.value = None
+        return
+
+    def reset_counts(self):
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return "cache hits %d misses %d (%d%% of reads saved)" % (
+            self.hits, self.misses, self.hits * 100 // total if total else 0)